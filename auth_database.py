@@ -1,45 +1,81 @@
 import logging
-from sqlalchemy import create_engine
+import time
+from functools import cached_property
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import StaticPool
 from typing import Generator
-from config import Config
+from config import config
 from auth_models import Base, User, Building, Drawing, ChatMessage
 
 logger = logging.getLogger(__name__)
 
+# Seconds to reuse the last health check result for repeated probes
+HEALTH_CACHE_TTL = 2.0
+
 class AuthDatabase:
     def __init__(self):
-        self.config = Config()
+        self.config = config
+        # The engine is built on first use, so importing this module never blocks on the database
+        self._health_checked_at = float('-inf')
+        self._health_status = False
+    
+    @cached_property
+    def database_url(self) -> str:
         # Use SQLite for local development, PostgreSQL for production
-        if self.config.POSTGRES_HOST == "localhost" and not hasattr(self, '_postgres_available'):
+        if self.config.POSTGRES_HOST == "localhost":
             # Check if PostgreSQL is available, fall back to SQLite
             try:
-                test_engine = create_engine(self.config.postgres_url)
+                test_engine = create_engine(self.config.POSTGRES_URL)
                 test_engine.connect().close()
-                self.database_url = self.config.postgres_url
+                test_engine.dispose()
                 logger.info("Using PostgreSQL database")
+                return self.config.POSTGRES_URL
             except Exception:
                 # Fall back to SQLite for local development
-                self.database_url = "sqlite:///./auth.db"
                 logger.info("PostgreSQL not available, using SQLite for development")
-        else:
-            self.database_url = self.config.postgres_url
-            logger.info("Using PostgreSQL database")
+                return "sqlite:///./auth.db"
         
-        self.engine = create_engine(
+        logger.info("Using PostgreSQL database")
+        return self.config.POSTGRES_URL
+    
+    @cached_property
+    def engine(self):
+        if self.database_url.startswith("sqlite"):
+            # One shared connection across FastAPI's worker threads
+            return create_engine(
+                self.database_url,
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+                echo=False  # Set to True for SQL debugging
+            )
+        return create_engine(
             self.database_url,
             pool_pre_ping=True,
+            pool_size=self.config.DB_POOL_SIZE,
+            max_overflow=self.config.DB_MAX_OVERFLOW,
+            pool_recycle=self.config.DB_POOL_RECYCLE,
+            pool_timeout=self.config.DB_POOL_TIMEOUT,
+            connect_args={"options": f"-c statement_timeout={self.config.DB_STATEMENT_TIMEOUT_MS}"},
             echo=False  # Set to True for SQL debugging
         )
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+    
+    @cached_property
+    def SessionLocal(self) -> sessionmaker:
+        # Keep loaded attributes after commit so request handlers don't re-SELECT rows they just wrote
+        return sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine)
         
     def create_tables(self):
         """Create all tables"""
         try:
             Base.metadata.create_all(bind=self.engine)
+            # create_all skips tables that already exist, so add indexes introduced since then
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(bind=self.engine, checkfirst=True)
             logger.info("Database tables created successfully")
         except Exception as e:
-            logger.error(f"Failed to create tables: {e}")
+            logger.error("Failed to create tables: %s", e)
             raise
     
     def get_session(self) -> Generator[Session, None, None]:
@@ -52,13 +88,21 @@ class AuthDatabase:
     
     def health_check(self) -> bool:
         """Check database connectivity"""
+        now = time.monotonic()
+        if now - self._health_checked_at < HEALTH_CACHE_TTL:
+            return self._health_status
+        
         try:
             with self.engine.connect() as conn:
-                conn.execute("SELECT 1")
-                return True
+                conn.execute(text("SELECT 1"))
+            healthy = True
         except Exception as e:
-            logger.error(f"Database health check failed: {e}")
-            return False
+            logger.error("Database health check failed: %s", e)
+            healthy = False
+        
+        self._health_status = healthy
+        self._health_checked_at = now
+        return healthy
 
 # Global database instance
 auth_db = AuthDatabase()
\ No newline at end of file
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Index, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, column_property
 from sqlalchemy.sql import func
 from pydantic import BaseModel
 from typing import Optional, List
@@ -30,7 +30,7 @@ class Building(Base):
     name = Column(String(255), nullable=False)
     address = Column(Text)
     description = Column(Text)
-    owner_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    owner_user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
@@ -39,11 +39,15 @@ class Building(Base):
 
 class Drawing(Base):
     __tablename__ = "drawings"
+    # Image lookups filter on scene_graph_id and join to the building, answered from this index alone
+    __table_args__ = (
+        Index("ix_drawings_scene_graph_id_building_id", "scene_graph_id", "building_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String(255), nullable=False)
     title = Column(String(255))
-    building_id = Column(Integer, ForeignKey("buildings.id"), nullable=False)
+    building_id = Column(Integer, ForeignKey("buildings.id"), nullable=False, index=True)
     scene_graph_id = Column(String(255))  # Links to Neo4j diagram
     uploaded_by = Column(Integer, ForeignKey("users.id"), nullable=False)
     file_path = Column(String(500))  # Future: Azure Blob Storage path
@@ -54,6 +58,14 @@ class Drawing(Base):
     uploader = relationship("User", back_populates="uploaded_drawings")
     chat_messages = relationship("ChatMessage", back_populates="drawing")
 
+# Drawing count loaded in the same SELECT as the building (avoids a per-building COUNT query)
+Building.drawing_count = column_property(
+    select(func.count(Drawing.id))
+    .where(Drawing.building_id == Building.id)
+    .correlate_except(Drawing)
+    .scalar_subquery()
+)
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
@@ -1,33 +1,89 @@
+import hashlib
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
+from typing import List, Optional, Tuple
+import jwt
 import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from sqlalchemy import select, bindparam
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from auth_models import User, UserCreate, UserResponse, Token
 from auth_database import auth_db
-from config import Config
+from config import config
+from cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Argon2id with the OWASP 46 MiB / t=2 / p=1 profile
+password_hasher = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)
+
+# Hot-path lookups built once; the bound-parameter form hits the compiled statement cache
+USER_BY_USERNAME = select(User).where(User.username == bindparam("username"))
+USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+
+# Resolved users are reused for this long; tokens are still checked against their own expiry
+USER_CACHE_TTL = 60  # seconds
+
+# Dialect-specific INSERT constructs that support ON CONFLICT ... RETURNING
+INSERT_BY_DIALECT = {
+    "postgresql": postgresql_insert,
+    "sqlite": sqlite_insert,
+}
+
 class AuthService:
     def __init__(self):
-        self.config = Config()
+        self.config = config
+        # Decoded tokens keyed by a digest of the token; each entry lives until the token's exp
+        self._token_cache = TTLCache(maxsize=4096)
+        # Users resolved from tokens as plain UserResponse values (never ORM instances, which are
+        # bound to the request's session), keyed by username; see invalidate_user
+        self._user_cache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL)
     
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """Verify a plain password against its hash"""
-        # Ensure password is bytes and within bcrypt limit
-        password_bytes = plain_password[:72].encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hashed_password.encode('utf-8'))
+        if self._is_legacy_hash(hashed_password):
+            # Legacy bcrypt hashes were created from the first 72 characters
+            password_bytes = plain_password[:72].encode('utf-8')
+            return bcrypt.checkpw(password_bytes, hashed_password.encode('utf-8'))
+        try:
+            return password_hasher.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def verify_many(self, pairs: List[Tuple[str, str]]) -> List[bool]:
+        """Verify (plain_password, hashed_password) pairs in parallel
+        
+        libargon2 releases the GIL while hashing, so each worker thread
+        verifies on its own core.
+        """
+        if not pairs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(pairs), os.cpu_count() or 1)) as executor:
+            return list(executor.map(lambda pair: self.verify_password(*pair), pairs))
     
     def get_password_hash(self, password: str) -> str:
         """Generate password hash"""
-        # Ensure password is within bcrypt 72-byte limit
-        password_bytes = password[:72].encode('utf-8')
-        salt = bcrypt.gensalt()
-        hashed = bcrypt.hashpw(password_bytes, salt)
-        return hashed.decode('utf-8')
+        return password_hasher.hash(password)
+    
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Check whether a stored hash should be upgraded to the current Argon2id parameters"""
+        if self._is_legacy_hash(hashed_password):
+            return True
+        try:
+            return password_hasher.check_needs_rehash(hashed_password)
+        except InvalidHashError:
+            return True
+    
+    @staticmethod
+    def _is_legacy_hash(hashed_password: str) -> bool:
+        return hashed_password.startswith(("$2a$", "$2b$", "$2y$"))
     
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None) -> str:
         """Create JWT access token"""
@@ -43,45 +99,60 @@ class AuthService:
     
     def verify_token(self, token: str) -> Optional[dict]:
         """Verify and decode JWT token"""
+        cache_key = self._token_key(token)
+        cached = self._token_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             payload = jwt.decode(token, self.config.SECRET_KEY, algorithms=[self.config.ALGORITHM])
             username: str = payload.get("sub")
             if username is None:
                 return None
-            return {"username": username}
-        except JWTError:
+            result = {"username": username}
+            
+            expires_at = payload.get("exp")
+            if expires_at is not None:
+                self._token_cache.set(cache_key, result, ttl=expires_at - time.time())
+            return result
+        except jwt.InvalidTokenError:
             return None
     
+    @staticmethod
+    def _token_key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+    
     def get_user_by_username(self, db: Session, username: str) -> Optional[User]:
         """Get user by username"""
-        return db.query(User).filter(User.username == username).first()
+        return db.scalars(USER_BY_USERNAME, {"username": username}).first()
     
     def get_user_by_id(self, db: Session, user_id: int) -> Optional[User]:
         """Get user by ID"""
-        return db.query(User).filter(User.id == user_id).first()
+        return db.scalars(USER_BY_ID, {"user_id": user_id}).first()
     
     def create_user(self, db: Session, user: UserCreate) -> User:
         """Create new user"""
-        # Check if username already exists
-        existing_user = self.get_user_by_username(db, user.username)
-        if existing_user:
+        hashed_password = self.get_password_hash(user.password)
+        
+        # Insert unless the username is taken, in a single round-trip
+        insert = INSERT_BY_DIALECT[db.get_bind().dialect.name]
+        stmt = insert(User)\
+            .values(username=user.username, password_hash=hashed_password, email=user.email)\
+            .on_conflict_do_nothing(index_elements=[User.username])\
+            .returning(User)
+        db_user = db.scalars(stmt).first()
+        
+        if db_user is None:
+            db.rollback()
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Username already registered"
             )
         
-        # Create new user
-        hashed_password = self.get_password_hash(user.password)
-        db_user = User(
-            username=user.username,
-            password_hash=hashed_password,
-            email=user.email
-        )
-        db.add(db_user)
         db.commit()
-        db.refresh(db_user)
+        self.invalidate_user(user.username)
         
-        logger.info(f"Created new user: {user.username}")
+        logger.info("Created new user: %s", user.username)
         return db_user
     
     def authenticate_user(self, db: Session, username: str, password: str) -> Optional[User]:
@@ -91,9 +162,19 @@ class AuthService:
             return None
         if not self.verify_password(password, user.password_hash):
             return None
+        
+        # Transparently upgrade legacy bcrypt (or outdated Argon2) hashes
+        if self.needs_rehash(user.password_hash):
+            user.password_hash = self.get_password_hash(password)
+            db.commit()
+            logger.info("Upgraded password hash for user: %s", username)
         return user
     
-    def get_current_user_from_token(self, db: Session, token: str) -> Optional[User]:
+    def invalidate_user(self, username: str):
+        """Forget the cached user; call whenever a user is created, deleted or changes credentials"""
+        self._user_cache.pop(username)
+    
+    def get_current_user_from_token(self, db: Session, token: str) -> Optional[UserResponse]:
         """Get current user from JWT token"""
         payload = self.verify_token(token)
         if payload is None:
@@ -103,8 +184,16 @@ class AuthService:
         if username is None:
             return None
         
+        cached = self._user_cache.get(username)
+        if cached is not None:
+            return cached
+        
         user = self.get_user_by_username(db, username)
-        return user
+        if user is None:
+            return None
+        current_user = UserResponse.model_validate(user)
+        self._user_cache.set(username, current_user)
+        return current_user
 
 # Global auth service instance
 auth_service = AuthService()
\ No newline at end of file
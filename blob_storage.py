@@ -1,97 +1,186 @@
 import os
+import asyncio
 import logging
 import uuid
-from typing import Optional, Tuple
+from functools import cached_property
+from types import MappingProxyType
+from typing import BinaryIO, Optional, Tuple
 from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.core.exceptions import AzureError
-from config import Config
+from azure.core.pipeline.transport import RequestsTransport
+import requests
+from config import config
 
 logger = logging.getLogger(__name__)
 
+# Upload tuning: files up to MAX_FILE_SIZE go out as a single PUT
+MAX_SINGLE_PUT_SIZE = 16 * 1024 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+
+CONTENT_TYPE_MAP = MappingProxyType({
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.pdf': 'application/pdf'
+})
+
+def get_file_extension(filename: str) -> str:
+    """Return the lowercased extension including the dot, or '' if there is none"""
+    _, dot, ext = filename.rpartition('.')
+    return f".{ext.lower()}" if dot else ""
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+def content_type_for(filename: str) -> str:
+    return CONTENT_TYPE_MAP.get(get_file_extension(filename), DEFAULT_CONTENT_TYPE)
+
 class BlobStorageService:
     def __init__(self):
-        self.config = Config()
+        self.config = config
         
         # Azure Blob Storage configuration
         self.account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
         self.container_name = os.getenv("AZURE_STORAGE_CONTAINER_NAME", "uploaded-images")
+        self.connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         
-        # Initialize blob client
-        if self.account_name:
-            # Production: Use managed identity or connection string
-            connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-            if connection_string:
-                self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-                logger.info("Initialized Azure Blob Storage with connection string")
-            else:
-                # Use managed identity for production
-                from azure.identity import DefaultAzureCredential
-                credential = DefaultAzureCredential()
-                account_url = f"https://{self.account_name}.blob.core.windows.net"
-                self.blob_service_client = BlobServiceClient(account_url=account_url, credential=credential)
-                logger.info("Initialized Azure Blob Storage with managed identity")
-        else:
-            # Local development fallback - use file system
-            self.blob_service_client = None
+        # Clients are created on first use, so importing this module does no credential or network work
+        if not self.account_name:
             logger.warning("Azure Blob Storage not configured, using local file storage fallback")
-            
-            # Import and use local file storage
-            from file_storage import FileStorageService
-            self.local_storage = FileStorageService()
     
-    def save_uploaded_file(self, file_bytes: bytes, original_filename: str, user_id: int, building_id: int) -> Tuple[str, str]:
+    @property
+    def account_url(self) -> str:
+        return f"https://{self.account_name}.blob.core.windows.net"
+    
+    @cached_property
+    def container_url_prefix(self) -> str:
+        return f"{self.account_url}/{self.container_name}/"
+    
+    def blob_name(self, blob_path: str) -> str:
+        """Blob name for a stored path, which may be a full blob URL"""
+        return blob_path.removeprefix(self.container_url_prefix)
+    
+    @cached_property
+    def _http_session(self) -> requests.Session:
+        """HTTPS session for the sync client, with a pool sized for the sync endpoint threads that stream images"""
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.SYNC_ENDPOINT_THREADS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    @cached_property
+    def blob_service_client(self) -> Optional[BlobServiceClient]:
+        if not self.account_name:
+            return None
+        
+        transport = RequestsTransport(session=self._http_session, session_owner=False)
+        if self.connection_string:
+            client = BlobServiceClient.from_connection_string(self.connection_string, transport=transport)
+            logger.info("Initialized Azure Blob Storage with connection string")
+        else:
+            # Use managed identity for production
+            from azure.identity import DefaultAzureCredential
+            client = BlobServiceClient(account_url=self.account_url, credential=DefaultAzureCredential(), transport=transport)
+            logger.info("Initialized Azure Blob Storage with managed identity")
+        return client
+    
+    @cached_property
+    def async_blob_service_client(self) -> Optional[AsyncBlobServiceClient]:
+        """Long-lived async client so uploads reuse pooled HTTPS connections"""
+        if not self.account_name:
+            return None
+        
+        if self.connection_string:
+            return AsyncBlobServiceClient.from_connection_string(
+                self.connection_string,
+                max_single_put_size=MAX_SINGLE_PUT_SIZE,
+                max_block_size=MAX_BLOCK_SIZE
+            )
+        
+        from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+        return AsyncBlobServiceClient(
+            account_url=self.account_url,
+            credential=AsyncDefaultAzureCredential(),
+            max_single_put_size=MAX_SINGLE_PUT_SIZE,
+            max_block_size=MAX_BLOCK_SIZE
+        )
+    
+    @cached_property
+    def local_storage(self):
+        """Local development fallback - use file system (the process-wide instance)"""
+        from file_storage import file_storage
+        return file_storage
+    
+    async def save_uploaded_file(self, file_obj: BinaryIO, original_filename: str, user_id: int, building_id: int) -> Tuple[str, str]:
         """
         Save uploaded file to Azure Blob Storage
         
+        Args:
+            file_obj: Readable binary stream positioned at the start of the file
+            
         Returns:
             Tuple of (unique_file_id, blob_url)
         """
         try:
-            if not self.blob_service_client:
+            if not self.account_name:
                 # Fallback to local storage for development
-                return self.local_storage.save_uploaded_file(file_bytes, original_filename, user_id, building_id)
+                return await asyncio.to_thread(
+                    self.local_storage.save_uploaded_file, file_obj, original_filename, user_id, building_id
+                )
             
             # Generate unique file ID and blob name
             file_id = str(uuid.uuid4())
-            file_extension = os.path.splitext(original_filename)[1].lower()
+            file_extension = get_file_extension(original_filename)
             
             # Organize blobs: users/{user_id}/buildings/{building_id}/{file_id}{ext}
             blob_name = f"users/{user_id}/buildings/{building_id}/{file_id}{file_extension}"
             
             # Determine content type
-            content_type_map = {
-                '.png': 'image/png',
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.pdf': 'application/pdf'
-            }
-            content_type = content_type_map.get(file_extension, 'application/octet-stream')
+            content_type = CONTENT_TYPE_MAP.get(file_extension, DEFAULT_CONTENT_TYPE)
             
             # Upload to blob storage
-            blob_client = self.blob_service_client.get_blob_client(
+            blob_client = self.async_blob_service_client.get_blob_client(
                 container=self.container_name,
                 blob=blob_name
             )
             
-            blob_client.upload_blob(
-                file_bytes,
+            # The SDK reads the stream in MAX_BLOCK_SIZE chunks for large files
+            await blob_client.upload_blob(
+                file_obj,
                 overwrite=True,
                 content_settings=ContentSettings(content_type=content_type)
             )
             
             # Generate public URL
-            blob_url = f"https://{self.account_name}.blob.core.windows.net/{self.container_name}/{blob_name}"
+            blob_url = f"{self.account_url}/{self.container_name}/{blob_name}"
             
-            logger.info(f"Uploaded file to blob storage: {original_filename} -> {blob_name}")
+            logger.info("Uploaded file to blob storage: %s -> %s", original_filename, blob_name)
             return file_id, blob_url
             
         except AzureError as e:
-            logger.error(f"Azure Blob Storage error: {e}")
+            logger.error("Azure Blob Storage error: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Failed to save file to blob storage: {e}")
+            logger.error("Failed to save file to blob storage: %s", e)
             raise
     
+    async def close(self):
+        """Close both clients and their pooled connections, and finish local fsyncs"""
+        # Only close clients that were actually created
+        client = self.__dict__.get('async_blob_service_client')
+        if client:
+            await client.close()
+        sync_client = self.__dict__.get('blob_service_client')
+        if sync_client:
+            sync_client.close()
+        session = self.__dict__.get('_http_session')
+        if session:
+            session.close()
+        local_storage = self.__dict__.get('local_storage')
+        if local_storage:
+            await asyncio.to_thread(local_storage.close)
+    
     def get_blob_url(self, blob_path: str) -> Optional[str]:
         """
         Get public URL for a blob
@@ -103,7 +192,7 @@ class BlobStorageService:
             Public blob URL or None if not found
         """
         try:
-            if not self.blob_service_client:
+            if not self.account_name:
                 # Local storage fallback
                 file_path = self.local_storage.get_file_path(blob_path)
                 return f"/local-files/{blob_path}" if file_path else None
@@ -113,10 +202,10 @@ class BlobStorageService:
                 return blob_path
             
             # Generate URL from blob name
-            return f"https://{self.account_name}.blob.core.windows.net/{self.container_name}/{blob_path}"
+            return f"{self.account_url}/{self.container_name}/{blob_path}"
             
         except Exception as e:
-            logger.error(f"Error getting blob URL: {e}")
+            logger.error("Error getting blob URL: %s", e)
             return None
     
     def delete_blob(self, blob_path: str) -> bool:
@@ -130,7 +219,7 @@ class BlobStorageService:
             True if deleted successfully
         """
         try:
-            if not self.blob_service_client:
+            if not self.account_name:
                 # Local storage fallback
                 return self.local_storage.delete_file(blob_path)
             
@@ -146,17 +235,17 @@ class BlobStorageService:
             )
             
             blob_client.delete_blob()
-            logger.info(f"Deleted blob: {blob_name}")
+            logger.info("Deleted blob: %s", blob_name)
             return True
             
         except Exception as e:
-            logger.error(f"Error deleting blob: {e}")
+            logger.error("Error deleting blob: %s", e)
             return False
     
     def get_storage_info(self) -> dict:
         """Get storage system information"""
         try:
-            if not self.blob_service_client:
+            if not self.account_name:
                 return self.local_storage.get_storage_info()
             
             # Count blobs in container
@@ -170,7 +259,7 @@ class BlobStorageService:
                 "total_blobs": blob_count
             }
         except Exception as e:
-            logger.error(f"Error getting storage info: {e}")
+            logger.error("Error getting storage info: %s", e)
             return {"error": str(e)}
 
 # Global blob storage instance
@@ -1,107 +1,274 @@
+import queue
 import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import List, Optional
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
 from chat_models import ChatMessage
 import logging
 
 logger = logging.getLogger(__name__)
 
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (id, diagram_id, role, content, timestamp, confidence)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Bumped whenever the messages table layout changes (stored in PRAGMA user_version)
+SCHEMA_VERSION = 2
+
+CREATE_MESSAGES_SQL = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id BLOB PRIMARY KEY,  -- 16-byte UUID
+        diagram_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,  -- unix epoch milliseconds
+        confidence REAL
+    )
+"""
+
+# Background writer batching: flush after this many messages or this many seconds
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_INTERVAL = 0.05
+
 class ChatService:
     def __init__(self, db_path: str = "chat_history.db"):
         self.db_path = db_path
+        self._lock = threading.Lock()
+        self.conn = self._connect()
         self.init_database()
+        
+        # History reads use a read-only connection per thread, so they neither wait on writes nor on each other
+        self._read_local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._read_conns_lock = threading.Lock()
+        
+        # Messages are queued by save_message and written in batches by a background thread.
+        # Each queued row carries a sequence number so flush() can wait for just the rows queued before it.
+        self._write_queue: "queue.Queue[Optional[Tuple[int, tuple]]]" = queue.Queue()
+        self._queue_lock = threading.Lock()
+        self._queued_seq = 0
+        self._written = threading.Condition()
+        self._written_seq = 0
+        self._writer = threading.Thread(target=self._writer_loop, name="chat-writer", daemon=True)
+        self._writer.start()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open the shared SQLite connection used by all chat operations"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        return conn
+    
+    def _connect_readonly(self) -> sqlite3.Connection:
+        """Open a read-only connection; WAL lets it read while the writer commits"""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=1")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        return conn
+    
+    def _read_conn(self) -> sqlite3.Connection:
+        """This thread's read-only connection, opened on first use"""
+        conn = getattr(self._read_local, 'conn', None)
+        if conn is None:
+            conn = self._read_local.conn = self._connect_readonly()
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
     
     def init_database(self):
         """Initialize SQLite database for chat history"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id TEXT PRIMARY KEY,
-                        diagram_id TEXT NOT NULL,
-                        role TEXT NOT NULL,
-                        content TEXT NOT NULL,
-                        timestamp TEXT NOT NULL,
-                        confidence REAL
-                    )
-                """)
-                conn.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_diagram_timestamp 
-                    ON messages(diagram_id, timestamp)
+            with self._lock, self.conn:
+                table_exists = self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'"
+                ).fetchone() is not None
+                version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                
+                if not table_exists:
+                    self.conn.execute(CREATE_MESSAGES_SQL)
+                elif version < SCHEMA_VERSION:
+                    self._migrate_messages_table(version)
+                
+                self.conn.execute("DROP INDEX IF EXISTS idx_diagram_timestamp")
+                self.conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_diagram_timestamp_desc 
+                    ON messages(diagram_id, timestamp DESC)
                 """)
-                conn.commit()
+                self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
                 logger.info("Chat database initialized")
         except Exception as e:
-            logger.error(f"Failed to initialize chat database: {e}")
+            logger.error("Failed to initialize chat database: %s", e)
             raise
     
+    def _migrate_messages_table(self, version: int):
+        """Rebuild the messages table in the current layout, converting columns from older versions"""
+        # v1: ISO-8601 TEXT timestamps -> INTEGER epoch milliseconds.
+        # Legacy rows hold naive local times (datetime.now()), so 'utc' converts them from local time first.
+        timestamp_expr = "timestamp" if version >= 1 else \
+            "CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+        # v2: 36-char TEXT UUIDs -> 16-byte BLOBs
+        id_expr = "id" if version >= 2 else "uuid_bytes(id)"
+        self.conn.create_function("uuid_bytes", 1, lambda value: uuid.UUID(value).bytes, deterministic=True)
+        
+        self.conn.execute("ALTER TABLE messages RENAME TO messages_old")
+        self.conn.execute(CREATE_MESSAGES_SQL)
+        self.conn.execute(f"""
+            INSERT INTO messages (id, diagram_id, role, content, timestamp, confidence)
+            SELECT {id_expr}, diagram_id, role, content, {timestamp_expr}, confidence
+            FROM messages_old
+        """)
+        self.conn.execute("DROP TABLE messages_old")
+        logger.info("Migrated chat messages table from schema version %s to %s", version, SCHEMA_VERSION)
+    
     def save_message(self, message: ChatMessage) -> bool:
-        """Save a chat message to the database"""
+        """Queue a chat message for the background batch writer"""
+        row = self._message_row(message)
+        with self._queue_lock:
+            self._queued_seq += 1
+            self._write_queue.put((self._queued_seq, row))
+        return True
+    
+    def save_messages(self, messages: List[ChatMessage]) -> bool:
+        """Save several chat messages in a single transaction"""
+        return self._write_rows([self._message_row(message) for message in messages])
+    
+    def flush(self):
+        """Wait until every message queued before this call has been written"""
+        with self._queue_lock:
+            target = self._queued_seq
+        with self._written:
+            self._written.wait_for(lambda: self._written_seq >= target)
+    
+    def _mark_written(self, seq: int):
+        with self._written:
+            self._written_seq = seq
+            self._written.notify_all()
+    
+    @staticmethod
+    def _message_row(message: ChatMessage) -> tuple:
+        return (
+            uuid.UUID(message.id).bytes,
+            message.diagram_id,
+            message.role,
+            message.content,
+            int(message.timestamp.timestamp() * 1000),
+            message.confidence
+        )
+    
+    def _write_rows(self, rows: List[tuple]) -> bool:
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT INTO messages (id, diagram_id, role, content, timestamp, confidence)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    message.id,
-                    message.diagram_id,
-                    message.role,
-                    message.content,
-                    message.timestamp.isoformat(),
-                    message.confidence
-                ))
-                conn.commit()
+            with self._lock, self.conn:
+                self.conn.executemany(INSERT_MESSAGE_SQL, rows)
                 return True
         except Exception as e:
-            logger.error(f"Failed to save message: {e}")
+            logger.error("Failed to save %s message(s): %s", len(rows), e)
             return False
     
+    def _writer_loop(self):
+        """Drain the write queue, committing up to WRITE_BATCH_SIZE messages per transaction"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            
+            items = [item]
+            stop = False
+            deadline = time.monotonic() + WRITE_BATCH_INTERVAL
+            while len(items) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+            
+            # Failed batches are logged by _write_rows; they still count as done so flush() never hangs
+            self._write_rows([row for _, row in items])
+            self._mark_written(items[-1][0])
+            
+            if stop:
+                return
+    
     def get_chat_history(self, diagram_id: str, limit: int = 50) -> List[ChatMessage]:
         """Get chat history for a diagram"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.execute("""
+            # Newest `limit` rows, returned in chronological order by the database.
+            # Messages still in the write queue (at most WRITE_BATCH_INTERVAL old) are not included.
+            rows = self._read_conn().execute("""
+                SELECT * FROM (
                     SELECT * FROM messages 
                     WHERE diagram_id = ? 
                     ORDER BY timestamp DESC 
                     LIMIT ?
-                """, (diagram_id, limit))
-                
-                messages = []
-                for row in cursor:
-                    message = ChatMessage(
-                        id=row['id'],
-                        diagram_id=row['diagram_id'],
-                        role=row['role'],
-                        content=row['content'],
-                        timestamp=datetime.fromisoformat(row['timestamp']),
-                        confidence=row['confidence']
-                    )
-                    messages.append(message)
-                
-                # Return in chronological order
-                return list(reversed(messages))
+                ) ORDER BY timestamp ASC
+            """, (diagram_id, limit)).fetchall()
+            
+            fromtimestamp = datetime.fromtimestamp
+            utc = timezone.utc
+            return [
+                ChatMessage(
+                    id=str(uuid.UUID(bytes=row['id'])),
+                    diagram_id=row['diagram_id'],
+                    role=row['role'],
+                    content=row['content'],
+                    timestamp=fromtimestamp(row['timestamp'] / 1000, utc),
+                    confidence=row['confidence']
+                )
+                for row in rows
+            ]
                 
         except Exception as e:
-            logger.error(f"Failed to get chat history: {e}")
+            logger.error("Failed to get chat history: %s", e)
             return []
     
     def clear_chat_history(self, diagram_id: str) -> bool:
         """Clear chat history for a diagram"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("DELETE FROM messages WHERE diagram_id = ?", (diagram_id,))
-                conn.commit()
+            self.flush()
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM messages WHERE diagram_id = ?", (diagram_id,))
                 return True
         except Exception as e:
-            logger.error(f"Failed to clear chat history: {e}")
+            logger.error("Failed to clear chat history: %s", e)
             return False
     
-    def create_message_id(self) -> str:
-        """Generate a unique message ID"""
-        return str(uuid.uuid4())
+    def close(self):
+        """Stop the background writer and close the shared database connection"""
+        self._write_queue.put(None)
+        self._writer.join()
+        # Messages queued after the shutdown sentinel are written here
+        items = []
+        while True:
+            try:
+                item = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                items.append(item)
+        if items:
+            self._write_rows([row for _, row in items])
+            self._mark_written(items[-1][0])
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        with self._lock:
+            self.conn.close()
 
 # Global chat service instance
-chat_service = ChatService()
\ No newline at end of file
+chat_service = ChatService()
@@ -21,6 +21,23 @@ class Config:
     POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
     POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
     
+    # SQLAlchemy connection pool
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "30"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))  # seconds
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "5"))  # seconds
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+    
+    # Thread pool for blocking work (OpenAI, Neo4j, PDF/image processing) run off the event loop
+    WORKER_THREADS = int(os.getenv("WORKER_THREADS", str(min(32, (os.cpu_count() or 1) + 4))))
+    # Threads available to plain `def` endpoints (database, Neo4j and blob SDK calls)
+    SYNC_ENDPOINT_THREADS = int(os.getenv("SYNC_ENDPOINT_THREADS", "100"))
+    
+    # Questions answered concurrently per chat WebSocket; further messages wait to be read
+    WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "2"))
+    # Larger WebSocket frames are rejected by the server before reaching the handler
+    WS_MAX_MESSAGE_SIZE = int(os.getenv("WS_MAX_MESSAGE_SIZE", str(1024 * 1024)))
+    
     # JWT Configuration
     SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
     ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))  # 24 hours
@@ -28,31 +45,28 @@ class Config:
     
     # File Upload Configuration
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-    ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".pdf"}
+    ALLOWED_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".pdf"})
     
     # Azure Blob Storage Configuration
     AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
     AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
     AZURE_STORAGE_CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME", "uploaded-images")
     
-    # Database URLs
-    @property
-    def postgres_url(self) -> str:
-        return f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
-    
-    @property
-    def postgres_url_async(self) -> str:
-        return f"postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+    # Database URLs (built once from the values above)
+    POSTGRES_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    POSTGRES_URL_ASYNC = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
     
     @classmethod
     def validate(cls):
-        instance = cls()
         required_vars = [
-            instance.OPENAI_API_KEY,
-            instance.NEO4J_URI,
-            instance.NEO4J_PASSWORD,
-            instance.SECRET_KEY
+            cls.OPENAI_API_KEY,
+            cls.NEO4J_URI,
+            cls.NEO4J_PASSWORD,
+            cls.SECRET_KEY
         ]
         if not all(required_vars):
             raise ValueError("Missing required environment variables")
-        return True
\ No newline at end of file
+        return True
+
+# Shared configuration instance; the environment is read once at import time
+config = Config()
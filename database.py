@@ -1,164 +1,240 @@
 import logging
+import os
+import threading
 import time
+from functools import lru_cache
+from types import MappingProxyType
 from neo4j import GraphDatabase
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional
 from config import Config
-from models import SceneGraph
+from models import SceneGraph, RelationshipType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
 
 logger = logging.getLogger(__name__)
 
+# Bolt connection pool shared by all sessions of the process-wide driver
+MAX_CONNECTION_POOL_SIZE = (os.cpu_count() or 1) * 4
+CONNECTION_ACQUISITION_TIMEOUT = 30  # seconds
+# Pooled connections idle longer than this are pinged before reuse (like SQLAlchemy's pool_pre_ping)
+LIVENESS_CHECK_TIMEOUT = 30  # seconds
+
+# Shared stand-in for missing property/position/dimension dicts
+EMPTY = MappingProxyType({})
+
+def to_json(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, separators=(',', ':'))
+
+def scalarize(value: Any) -> Any:
+    """Neo4j properties can't hold nested objects, so store dicts/lists as JSON strings"""
+    return to_json(value) if isinstance(value, (dict, list)) else value
+
+# Cypher statements, built once at import
+SCHEMA_CONSTRAINTS = (
+    "CREATE CONSTRAINT component_id IF NOT EXISTS FOR (c:Component) REQUIRE c.id IS UNIQUE",
+    "CREATE CONSTRAINT diagram_id IF NOT EXISTS FOR (d:Diagram) REQUIRE d.id IS UNIQUE",
+    "CREATE CONSTRAINT graph_state_id IF NOT EXISTS FOR (g:GraphState) REQUIRE g.id IS UNIQUE",
+)
+
+SCHEMA_INDEXES = (
+    "CREATE INDEX component_type IF NOT EXISTS FOR (c:Component) ON (c.type)",
+    "CREATE INDEX diagram_title IF NOT EXISTS FOR (d:Diagram) ON (d.title)",
+)
+
+DIAGRAM_MERGE_QUERY = """
+    MERGE (d:Diagram {id: $diagram_id})
+    SET d.title = $title,
+        d.diagram_type = $diagram_type,
+        d.source_filename = $source_filename,
+        d.processing_timestamp = $processing_timestamp,
+        d.scale = $scale,
+        d.building_zone = $building_zone,
+        d.floor_level = $floor_level,
+        d.created_at = datetime()
+"""
+
+# Bumped in every scene graph write so each worker can tell when its caches are stale
+GRAPH_GENERATION_BUMP_QUERY = """
+    MERGE (g:GraphState {id: 'scene_graphs'})
+    SET g.generation = coalesce(g.generation, 0) + 1
+"""
+
+GRAPH_GENERATION_QUERY = """
+    OPTIONAL MATCH (g:GraphState {id: 'scene_graphs'})
+    RETURN coalesce(g.generation, 0) as generation
+"""
+
+COMPONENTS_MERGE_QUERY = """
+    MATCH (d:Diagram {id: $diagram_id})
+    UNWIND $nodes AS n
+    MERGE (c:Component {id: n.id})
+    SET c.type = n.type,
+        c.name = n.name,
+        c.material = n.material,
+        c.diameter = n.diameter,
+        c.length = n.length,
+        c.flow_direction = n.flow_direction,
+        c.position_x = n.pos_x,
+        c.position_y = n.pos_y,
+        c.width = n.width,
+        c.height = n.height
+    MERGE (d)-[:CONTAINS]->(c)
+"""
+
+RELATIONSHIPS_MERGE_TEMPLATE = """
+    UNWIND $rels AS r
+    MATCH (source:Component {{id: r.source_id}})
+    MATCH (target:Component {{id: r.target_id}})
+    MERGE (source)-[e:{rel_type}]->(target)
+    SET e.distance = r.distance,
+        e.angle = r.angle
+"""
+
+DIAGRAM_INFO_QUERY = """
+    MATCH (d:Diagram {id: $diagram_id})
+    OPTIONAL MATCH (d)-[:CONTAINS]->(c:Component)
+    RETURN d.title as title, 
+           d.metadata as metadata,
+           count(c) as component_count
+"""
+
+# Diagram, components and relationships in one round trip, as used for question answering;
+# the subqueries aggregate, so a diagram without components still yields a row
+COMPLETE_GRAPH_QUERY = """
+    MATCH (d:Diagram {id: $diagram_id})
+    CALL {
+        WITH d
+        MATCH (d)-[:CONTAINS]->(c:Component)
+        RETURN collect(c {
+            .id, .type, .name, .material, .diameter, .length, .flow_direction,
+            .position_x, .position_y, .width, .height
+        }) as components
+    }
+    CALL {
+        WITH d
+        MATCH (d)-[:CONTAINS]->(c1:Component)-[r]->(c2:Component)
+        WHERE type(r) IN ['CONNECTS_TO', 'FLOWS_TO', 'ABOVE', 'BELOW', 'PARALLEL_TO', 'SUPPORTS', 'CONTAINS']
+          AND (d)-[:CONTAINS]->(c2)
+        RETURN collect({
+            source_id: c1.id, target_id: c2.id, relationship_type: type(r),
+            distance: r.distance, angle: r.angle
+        }) as relationships
+    }
+    RETURN d.title as title, d.metadata as metadata, components, relationships
+"""
+
+ALL_DIAGRAMS_QUERY = """
+    MATCH (d:Diagram)
+    OPTIONAL MATCH (d)-[:CONTAINS]->(c:Component)
+    RETURN d.id as diagram_id,
+           d.title as title,
+           d.created_at as created_at,
+           count(c) as component_count
+    ORDER BY d.created_at DESC
+"""
+
+LATEST_DIAGRAM_QUERY = """
+    MATCH (d:Diagram)
+    RETURN d.id as diagram_id, d.title as title
+    ORDER BY d.created_at DESC
+    LIMIT 1
+"""
+
+# Seconds a successful health check is reused before the server is pinged again
+HEALTH_CACHE_TTL = 5.0
+
+# Relationship types cannot be query parameters, so only enum members are ever interpolated
+RELATIONSHIP_TYPES = frozenset(rel_type.value for rel_type in RelationshipType)
+
+@lru_cache(maxsize=len(RELATIONSHIP_TYPES))
+def relationships_query(rel_type: str) -> str:
+    """Build the (constant, plan-cacheable) UNWIND query for one relationship type"""
+    if rel_type not in RELATIONSHIP_TYPES:
+        raise ValueError(f"Unsupported relationship type: {rel_type!r}")
+    return RELATIONSHIPS_MERGE_TEMPLATE.format(rel_type=rel_type)
+
 class Neo4jDatabase:
     def __init__(self):
-        self.driver = None
-        self.connect()
+        # The driver is created on first use, so importing this module never opens sockets
+        self._driver = None
+        self._lock = threading.Lock()
+        self._healthy_at = float('-inf')
+        # The driver's sockets can't be shared with a forked worker; the child reconnects on first use
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    @property
+    def driver(self):
+        driver = self._driver
+        if driver is None:
+            with self._lock:
+                if self._driver is None:
+                    self.connect()
+                driver = self._driver
+        return driver
     
     def connect(self):
         try:
             Config.validate()
-            self.driver = GraphDatabase.driver(
+            self._driver = GraphDatabase.driver(
                 Config.NEO4J_URI,
                 auth=(Config.NEO4J_USERNAME, Config.NEO4J_PASSWORD),
-                max_connection_lifetime=60*10  # 10 minutes
+                max_connection_lifetime=60*10,  # 10 minutes
+                max_connection_pool_size=MAX_CONNECTION_POOL_SIZE,
+                connection_acquisition_timeout=CONNECTION_ACQUISITION_TIMEOUT,
+                liveness_check_timeout=LIVENESS_CHECK_TIMEOUT
             )
             logger.info("Connected to Neo4j Aura")
         except Exception as e:
             logger.error(f"Failed to connect to Neo4j: {e}")
             raise
     
+    def _reset_after_fork(self):
+        # Drop (without closing) the parent's driver; closing would tear down the parent's connections
+        self._driver = None
+        self._lock = threading.Lock()
+    
     def close(self):
-        if self.driver:
-            self.driver.close()
+        driver, self._driver = self._driver, None
+        if driver:
+            driver.close()
     
     def create_schema(self):
         with self.driver.session() as session:
             # Create constraints and indexes
-            constraints = [
-                "CREATE CONSTRAINT component_id IF NOT EXISTS FOR (c:Component) REQUIRE c.id IS UNIQUE",
-                "CREATE CONSTRAINT diagram_id IF NOT EXISTS FOR (d:Diagram) REQUIRE d.id IS UNIQUE",
-            ]
-            
-            indexes = [
-                "CREATE INDEX component_type IF NOT EXISTS FOR (c:Component) ON (c.type)",
-                "CREATE INDEX diagram_title IF NOT EXISTS FOR (d:Diagram) ON (d.title)",
-            ]
-            
-            for constraint in constraints:
+            for constraint in SCHEMA_CONSTRAINTS:
                 try:
                     session.run(constraint)
                 except Exception as e:
                     logger.warning(f"Constraint creation warning: {e}")
             
-            for index in indexes:
+            for index in SCHEMA_INDEXES:
                 try:
                     session.run(index)
                 except Exception as e:
                     logger.warning(f"Index creation warning: {e}")
     
     def store_scene_graph(self, scene_graph: SceneGraph) -> bool:
+        diagram_params, nodes_payload, rels_by_type = self._scene_graph_params(scene_graph)
+        
         max_retries = 3
         for attempt in range(max_retries):
             try:
+                # All writes for one scene graph commit together in a single transaction
                 with self.driver.session() as session:
-                    # Create diagram node - flatten metadata to avoid nested objects
-                    flattened_metadata = {}
-                    for key, value in scene_graph.metadata.items():
-                        if isinstance(value, (dict, list)):
-                            flattened_metadata[key] = str(value)
-                        else:
-                            flattened_metadata[key] = value
-                    
-                    session.run("""
-                        MERGE (d:Diagram {id: $diagram_id})
-                        SET d.title = $title,
-                            d.diagram_type = $diagram_type,
-                            d.source_filename = $source_filename,
-                            d.processing_timestamp = $processing_timestamp,
-                            d.scale = $scale,
-                            d.building_zone = $building_zone,
-                            d.floor_level = $floor_level,
-                            d.created_at = datetime()
-                    """, 
-                    diagram_id=scene_graph.diagram_id,
-                    title=scene_graph.title,
-                    diagram_type=flattened_metadata.get('diagram_type', ''),
-                    source_filename=flattened_metadata.get('source_filename', ''),
-                    processing_timestamp=flattened_metadata.get('processing_timestamp', ''),
-                    scale=flattened_metadata.get('scale', ''),
-                    building_zone=flattened_metadata.get('building_zone', ''),
-                    floor_level=flattened_metadata.get('floor_level', '')
+                    session.execute_write(
+                        self._store_scene_graph_tx,
+                        diagram_params,
+                        nodes_payload,
+                        rels_by_type
                     )
                     
-                    # Create component nodes
-                    for node in scene_graph.nodes:
-                        # Flatten properties
-                        flattened_props = {}
-                        if node.properties:
-                            for key, value in node.properties.items():
-                                if isinstance(value, (dict, list)):
-                                    flattened_props[key] = str(value)
-                                else:
-                                    flattened_props[key] = value
-                        
-                        # Flatten position and dimensions
-                        pos_x = node.position.get('x', 0) if node.position else 0
-                        pos_y = node.position.get('y', 0) if node.position else 0
-                        dim_width = node.dimensions.get('width', 0) if node.dimensions else 0
-                        dim_height = node.dimensions.get('height', 0) if node.dimensions else 0
-                        
-                        session.run("""
-                            MERGE (c:Component {id: $id})
-                            SET c.type = $type,
-                                c.name = $name,
-                                c.material = $material,
-                                c.diameter = $diameter,
-                                c.length = $length,
-                                c.flow_direction = $flow_direction,
-                                c.position_x = $pos_x,
-                                c.position_y = $pos_y,
-                                c.width = $width,
-                                c.height = $height
-                            WITH c
-                            MATCH (d:Diagram {id: $diagram_id})
-                            MERGE (d)-[:CONTAINS]->(c)
-                        """,
-                        id=node.id,
-                        type=node.type.value,
-                        name=node.name,
-                        material=flattened_props.get('material', ''),
-                        diameter=flattened_props.get('diameter', ''),
-                        length=flattened_props.get('length', ''),
-                        flow_direction=flattened_props.get('flow_direction', ''),
-                        pos_x=pos_x,
-                        pos_y=pos_y,
-                        width=dim_width,
-                        height=dim_height,
-                        diagram_id=scene_graph.diagram_id
-                        )
-                    
-                    # Create relationships
-                    for rel in scene_graph.relationships:
-                        # Flatten relationship properties
-                        rel_props = {}
-                        if rel.properties:
-                            for key, value in rel.properties.items():
-                                if isinstance(value, (dict, list)):
-                                    rel_props[key] = str(value)
-                                else:
-                                    rel_props[key] = value
-                        
-                        session.run(f"""
-                            MATCH (source:Component {{id: $source_id}})
-                            MATCH (target:Component {{id: $target_id}})
-                            MERGE (source)-[r:{rel.type.value}]->(target)
-                            SET r.distance = $distance,
-                                r.angle = $angle
-                        """,
-                        source_id=rel.source_id,
-                        target_id=rel.target_id,
-                        distance=rel_props.get('distance', ''),
-                        angle=rel_props.get('angle', '')
-                        )
-                    
                     logger.info(f"Scene graph {scene_graph.diagram_id} stored successfully")
                     return True
                     
@@ -171,11 +247,79 @@ class Neo4jDatabase:
                     logger.error(f"Failed to store scene graph after {max_retries} attempts: {e}")
                     return False
     
+    @staticmethod
+    def _scene_graph_params(scene_graph: SceneGraph):
+        """Build the query parameters for a scene graph once, outside the (retryable) transaction"""
+        # Diagram node - flatten metadata to avoid nested objects
+        metadata = scene_graph.metadata
+        diagram_params = {
+            'diagram_id': scene_graph.diagram_id,
+            'title': scene_graph.title,
+            'diagram_type': scalarize(metadata.get('diagram_type', '')),
+            'source_filename': scalarize(metadata.get('source_filename', '')),
+            'processing_timestamp': scalarize(metadata.get('processing_timestamp', '')),
+            'scale': scalarize(metadata.get('scale', '')),
+            'building_zone': scalarize(metadata.get('building_zone', '')),
+            'floor_level': scalarize(metadata.get('floor_level', ''))
+        }
+        
+        # Component nodes, flattened in one pass
+        nodes_payload = []
+        for node in scene_graph.nodes:
+            props = node.properties or EMPTY
+            position = node.position or EMPTY
+            dimensions = node.dimensions or EMPTY
+            nodes_payload.append({
+                'id': node.id,
+                'type': node.type.value,
+                'name': node.name,
+                'material': scalarize(props.get('material', '')),
+                'diameter': scalarize(props.get('diameter', '')),
+                'length': scalarize(props.get('length', '')),
+                'flow_direction': scalarize(props.get('flow_direction', '')),
+                'pos_x': position.get('x', 0),
+                'pos_y': position.get('y', 0),
+                'width': dimensions.get('width', 0),
+                'height': dimensions.get('height', 0)
+            })
+        
+        # Relationships, grouped by type
+        rels_by_type = {}
+        for rel in scene_graph.relationships:
+            props = rel.properties or EMPTY
+            rels_by_type.setdefault(rel.type.value, []).append({
+                'source_id': rel.source_id,
+                'target_id': rel.target_id,
+                'distance': scalarize(props.get('distance', '')),
+                'angle': scalarize(props.get('angle', ''))
+            })
+        
+        return diagram_params, nodes_payload, rels_by_type
+    
+    @staticmethod
+    def _store_scene_graph_tx(tx, diagram_params: Dict[str, Any], nodes_payload: List[Dict[str, Any]],
+                              rels_by_type: Dict[str, List[Dict[str, Any]]]):
+        tx.run(DIAGRAM_MERGE_QUERY, diagram_params)
+        
+        # All components in a single UNWIND round-trip
+        if nodes_payload:
+            tx.run(COMPONENTS_MERGE_QUERY, nodes=nodes_payload, diagram_id=diagram_params['diagram_id'])
+        
+        # One UNWIND per relationship type
+        for rel_type, rels_payload in rels_by_type.items():
+            tx.run(relationships_query(rel_type), rels=rels_payload)
+        
+        tx.run(GRAPH_GENERATION_BUMP_QUERY)
+    
+    def execute_cypher_iter(self, query: str, parameters: Optional[Dict] = None) -> Iterator[Dict[str, Any]]:
+        """Yield records one at a time; breaking early stops pulling the rest from the server"""
+        with self.driver.session() as session:
+            for record in session.run(query, parameters or {}):
+                yield record.data()
+    
     def execute_cypher(self, query: str, parameters: Optional[Dict] = None) -> List[Dict[str, Any]]:
         try:
-            with self.driver.session() as session:
-                result = session.run(query, parameters or {})
-                return [record.data() for record in result]
+            return list(self.execute_cypher_iter(query, parameters))
         except Exception as e:
             logger.error(f"Failed to execute Cypher query: {e}")
             raise
@@ -183,13 +327,7 @@ class Neo4jDatabase:
     def get_diagram_info(self, diagram_id: str) -> Optional[Dict[str, Any]]:
         try:
             with self.driver.session() as session:
-                result = session.run("""
-                    MATCH (d:Diagram {id: $diagram_id})
-                    OPTIONAL MATCH (d)-[:CONTAINS]->(c:Component)
-                    RETURN d.title as title, 
-                           d.metadata as metadata,
-                           count(c) as component_count
-                """, diagram_id=diagram_id)
+                result = session.run(DIAGRAM_INFO_QUERY, diagram_id=diagram_id)
                 
                 record = result.single()
                 return record.data() if record else None
@@ -197,31 +335,55 @@ class Neo4jDatabase:
             logger.error(f"Failed to get diagram info: {e}")
             return None
     
-    def get_all_diagrams(self) -> List[Dict[str, Any]]:
+    def get_complete_graph(self, diagram_id: str) -> Optional[Dict[str, Any]]:
+        """Diagram title/metadata with all its components and relationships, or None if it doesn't exist"""
         try:
             with self.driver.session() as session:
-                result = session.run("""
-                    MATCH (d:Diagram)
-                    OPTIONAL MATCH (d)-[:CONTAINS]->(c:Component)
-                    RETURN d.id as diagram_id,
-                           d.title as title,
-                           d.created_at as created_at,
-                           count(c) as component_count
-                    ORDER BY d.created_at DESC
-                """)
-                
-                return [record.data() for record in result]
+                record = session.run(COMPLETE_GRAPH_QUERY, diagram_id=diagram_id).single()
+                return record.data() if record else None
+        except Exception as e:
+            logger.error(f"Failed to get complete graph: {e}")
+            return None
+    
+    def iter_all_diagrams(self) -> Iterator[Dict[str, Any]]:
+        """Diagrams newest first, streamed"""
+        return self.execute_cypher_iter(ALL_DIAGRAMS_QUERY)
+    
+    def get_latest_diagram(self) -> Optional[Dict[str, Any]]:
+        """Id and title of the newest diagram, or None if there are none"""
+        with self.driver.session() as session:
+            record = session.run(LATEST_DIAGRAM_QUERY).single()
+            return record.data() if record else None
+    
+    def get_graph_generation(self) -> Optional[int]:
+        """Number of scene graph writes so far, or None if Neo4j can't be reached"""
+        try:
+            with self.driver.session() as session:
+                return session.run(GRAPH_GENERATION_QUERY).single()['generation']
+        except Exception as e:
+            logger.error(f"Failed to get graph generation: {e}")
+            return None
+    
+    def get_all_diagrams(self) -> List[Dict[str, Any]]:
+        try:
+            return list(self.iter_all_diagrams())
         except Exception as e:
             logger.error(f"Failed to get diagrams: {e}")
             return []
     
     def health_check(self) -> bool:
+        now = time.monotonic()
+        if now - self._healthy_at < HEALTH_CACHE_TTL:
+            return True
+        
         try:
-            with self.driver.session() as session:
-                result = session.run("RETURN 1")
-                return result.single() is not None
+            # Pings over a pooled connection, no transaction
+            self.driver.verify_connectivity()
         except Exception:
             return False
+        
+        self._healthy_at = now
+        return True
 
 # Global database instance
 db = Neo4jDatabase()
\ No newline at end of file
@@ -1,14 +1,61 @@
 import io
-import base64
+import os
+import binascii
 import logging
+import threading
 from pathlib import Path
-from typing import Tuple, Optional
+from types import MappingProxyType
+from typing import Tuple, Optional, Union
 import fitz  # PyMuPDF
 from PIL import Image
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# JPEG quality for rendered PDF pages sent to the vision model
+PDF_JPEG_QUALITY = 85
+
+# Pages render at 2x, capped so the long edge stays within what the vision model resolves;
+# large drawing sheets would otherwise render at 5000+ px
+PDF_RENDER_ZOOM = 2
+PDF_RENDER_MAX_EDGE = 2048
+
+# Images are downscaled to fit this box to reduce payload
+MAX_IMAGE_SIZE = (1024, 1024)
+
+# Formats the vision model accepts directly, so small RGB images skip the decode/re-encode
+PASSTHROUGH_FORMATS = frozenset({'PNG', 'JPEG'})
+
+# Leading bytes of each supported format, checked before handing data to a decoder
+FILE_SIGNATURES = MappingProxyType({
+    '.pdf': b'%PDF-',
+    '.png': b'\x89PNG\r\n\x1a\n',
+    '.jpg': b'\xff\xd8\xff',
+    '.jpeg': b'\xff\xd8\xff',
+})
+
+# PyMuPDF is not thread-safe, even across separate documents (they share one MuPDF context),
+# and uploads are processed on a thread pool, so all fitz work runs under this lock
+PDF_LOCK = threading.Lock()
+
+def extract_pdf_text(doc) -> str:
+    # "text" is MuPDF's fastest extractor
+    return "".join(page.get_text("text") for page in doc)
+
+def render_pdf_first_page(doc) -> bytes:
+    """Render the first page as JPEG for vision analysis"""
+    page = doc[0]
+    zoom = min(PDF_RENDER_ZOOM, PDF_RENDER_MAX_EDGE / max(page.rect.width, page.rect.height))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    # JPEG encodes far faster than PNG's DEFLATE and is much smaller on the wire
+    return pix.tobytes("jpeg", jpg_quality=PDF_JPEG_QUALITY)
+
+def open_pdf(source: Union[bytes, str]):
+    """Open a PDF from bytes or from a file path (MuPDF then reads the file lazily)"""
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
 class DocumentProcessor:
     def __init__(self):
         self.max_size = Config.MAX_FILE_SIZE
@@ -25,26 +72,30 @@ class DocumentProcessor:
         
         return True
     
-    def process_pdf(self, pdf_bytes: bytes) -> Tuple[str, str]:
+    def validate_signature(self, filename: str, file_bytes: bytes) -> bool:
+        """Reject files whose content doesn't match their extension, without decoding them"""
+        file_ext = Path(filename).suffix.lower()
+        signature = FILE_SIGNATURES.get(file_ext)
+        if signature is not None and not file_bytes.startswith(signature):
+            raise ValueError(f"File content does not match its {file_ext} extension")
+        
+        return True
+    
+    def process_pdf(self, pdf_source: Union[bytes, str]) -> Tuple[bytes, str]:
         try:
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            
-            # Extract text
-            text_content = ""
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text_content += page.get_text()
+            with PDF_LOCK:
+                doc = open_pdf(pdf_source)
+                try:
+                    page_count = doc.page_count
+                    text_content = extract_pdf_text(doc)
+                    img_data = render_pdf_first_page(doc)
+                finally:
+                    doc.close()
             
-            # Convert first page to image for vision analysis
-            page = doc[0]  # First page
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x zoom for better quality
-            img_data = pix.tobytes("png")
+            # Convert to base64 for OpenAI API (ASCII bytes; decoded once when the data URL is built)
+            img_base64 = binascii.b2a_base64(img_data, newline=False)
             
-            # Convert to base64 for OpenAI API
-            img_base64 = base64.b64encode(img_data).decode('utf-8')
-            
-            doc.close()
-            logger.info(f"Processed PDF: {len(doc)} pages, {len(text_content)} characters of text")
+            logger.info(f"Processed PDF: {page_count} pages, {len(text_content)} characters of text")
             
             return img_base64, text_content
             
@@ -52,43 +103,72 @@ class DocumentProcessor:
             logger.error(f"PDF processing error: {e}")
             raise ValueError(f"Failed to process PDF: {e}")
     
-    def process_image(self, image_bytes: bytes) -> str:
+    def process_image(self, image_source: Union[bytes, str]) -> bytes:
         try:
-            # Open and validate image
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Resize to smaller size to reduce payload (max 1024x1024 for better performance)
-            max_size = (1024, 1024)
-            if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-                image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                logger.info(f"Resized image to {image.size}")
-            
-            # Convert to base64
-            buffer = io.BytesIO()
-            image.save(buffer, format='PNG', optimize=True)
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            logger.info(f"Processed image: {image.size}, {len(img_base64)} base64 chars")
-            
-            return img_base64
+            # Open and validate image (from a path PIL reads the file as it decodes)
+            with Image.open(image_source if isinstance(image_source, str) else io.BytesIO(image_source)) as image:
+                
+                # open() only parses the header; images that need no conversion or resize are sent as-is
+                if (image.format in PASSTHROUGH_FORMATS and image.mode == 'RGB'
+                        and image.size[0] <= MAX_IMAGE_SIZE[0] and image.size[1] <= MAX_IMAGE_SIZE[1]):
+                    if isinstance(image_source, str):
+                        with open(image_source, 'rb') as f:
+                            image_source = f.read()
+                    img_base64 = binascii.b2a_base64(image_source, newline=False)
+                    logger.info(f"Processed image: {image.size} {image.format} passed through, {len(img_base64)} base64 chars")
+                    return img_base64
+                
+                # JPEGs decode straight at 1/2-1/8 scale when that still covers the target box
+                image.draft('RGB', MAX_IMAGE_SIZE)
+                
+                # Convert to RGB if necessary
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                
+                # Resize to smaller size to reduce payload (max 1024x1024 for better performance)
+                scale = max(image.size[0] / MAX_IMAGE_SIZE[0], image.size[1] / MAX_IMAGE_SIZE[1])
+                if scale > 1:
+                    # BOX is much cheaper than LANCZOS and indistinguishable at large reduction factors
+                    resample = Image.Resampling.BOX if scale > 2 else Image.Resampling.BILINEAR
+                    image.thumbnail(MAX_IMAGE_SIZE, resample)
+                    logger.info(f"Resized image to {image.size}")
+                
+                # Convert to base64
+                buffer = io.BytesIO()
+                image.save(buffer, format='PNG')
+                # Encode straight from the buffer's memory, without the getvalue() copy
+                img_base64 = binascii.b2a_base64(buffer.getbuffer(), newline=False)
+                
+                logger.info(f"Processed image: {image.size}, {len(img_base64)} base64 chars")
+                
+                return img_base64
             
         except Exception as e:
             logger.error(f"Image processing error: {e}")
             raise ValueError(f"Failed to process image: {e}")
     
-    def process_file(self, filename: str, file_bytes: bytes) -> Tuple[str, Optional[str]]:
-        self.validate_file(filename, len(file_bytes))
+    def validate_source(self, filename: str, source: Union[bytes, str]) -> bool:
+        """Check extension, size and signature of an upload given as bytes or as a file path"""
+        if isinstance(source, str):
+            content_length = os.path.getsize(source)
+            with open(source, 'rb') as f:
+                header = f.read(16)
+        else:
+            content_length = len(source)
+            header = source[:16]
+        self.validate_file(filename, content_length)
+        return self.validate_signature(filename, header)
+    
+    def process_file(self, filename: str, source: Union[bytes, str]) -> Tuple[bytes, Optional[str]]:
+        """Process an upload given as bytes or as the path of a file holding it"""
+        self.validate_source(filename, source)
         
         file_ext = Path(filename).suffix.lower()
         
         if file_ext == '.pdf':
-            return self.process_pdf(file_bytes)
+            return self.process_pdf(source)
         elif file_ext in {'.png', '.jpg', '.jpeg'}:
-            image_b64 = self.process_image(file_bytes)
+            image_b64 = self.process_image(source)
             return image_b64, None
         else:
-            raise ValueError(f"Unsupported file extension: {file_ext}")
\ No newline at end of file
+            raise ValueError(f"Unsupported file extension: {file_ext}")
@@ -1,25 +1,171 @@
 import os
+import hashlib
+import json
 import logging
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, Tuple
-import shutil
+from typing import BinaryIO, Optional, Tuple
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: the stats lock is then only held within this process
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+def content_hasher():
+    """BLAKE3 when installed, otherwise BLAKE2b; both yield 16-byte (32 hex char) digests"""
+    if blake3 is not None:
+        return blake3()
+    return hashlib.blake2b(digest_size=16)
+
+def content_id(hasher) -> str:
+    if blake3 is not None and isinstance(hasher, blake3):
+        return hasher.hexdigest(length=16)
+    return hasher.hexdigest()
+
+# Chunk size used when copying uploaded streams to disk
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Background workers that fsync finished uploads
+FSYNC_WORKERS = 2
+
+# Sidecar file holding the running file count and byte total for get_storage_info
+STATS_FILENAME = ".stats.json"
+# flock()ed around every stats update so uvicorn workers don't overwrite each other's totals
+LOCK_FILENAME = ".storage.lock"
+
+def write_stream(fd: int, file_obj: BinaryIO, hasher=None) -> int:
+    """Copy a stream to a raw file descriptor with plain write(2) calls; returns bytes written"""
+    total = 0
+    while True:
+        chunk = file_obj.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return total
+        if hasher is not None:
+            hasher.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        total += len(chunk)
+
+def fsync_path(path: str):
+    """Flush a file's data to disk; run off the request thread"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            if hasattr(os, "posix_fadvise"):
+                # Uploads are rarely read back soon; now that the pages are clean they can be dropped from the cache
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.error("Failed to fsync %s: %s", path, e)
+
+def iter_file_sizes(directory: str, seen: Optional[set] = None):
+    """Yield the size of every stored file under directory, counting hard-linked copies once
+    (scandir caches the stat per entry)"""
+    if seen is None:
+        seen = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Dot files are the stats sidecar, its lock and in-progress uploads
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    yield stat.st_size
+            elif entry.is_dir(follow_symlinks=False):
+                yield from iter_file_sizes(entry.path, seen)
+
+def content_file_name(upload_name: str) -> str:
+    """Name of the shared content file an upload link points at ("<id>-<tag>.png" -> "<id>.png")"""
+    stem, ext = os.path.splitext(upload_name)
+    return stem.split('-', 1)[0] + ext
+
 class FileStorageService:
     def __init__(self):
         # Storage directory - works for local, Docker volume, and K8s persistent volume
         self.storage_dir = Path(os.getenv("STORAGE_DIR", "./uploaded_images"))
         self.storage_dir.mkdir(parents=True, exist_ok=True)
-        logger.info(f"File storage initialized: {self.storage_dir.absolute()}")
+        logger.info("File storage initialized: %s", self.storage_dir.absolute())
+        # Hot paths build paths with os.path on this string instead of allocating Path objects
+        self._storage_root = str(self.storage_dir)
+        
+        # Totals are maintained incrementally in a sidecar shared by all workers instead of
+        # walking the tree on every request; updates are read-modify-write under a file lock
+        self.stats_path = self.storage_dir / STATS_FILENAME
+        self.lock_path = self.storage_dir / LOCK_FILENAME
+        self._stats_lock = threading.Lock()
+        with self._locked_stats():
+            if self._read_stats() is None:
+                self._recompute_stats()
+        
+        # Durability tradeoff: save_uploaded_file returns once the data is in the page cache.
+        # The fsync runs here in the background, so a crash right after an upload can lose it.
+        self._fsync_pool = ThreadPoolExecutor(max_workers=FSYNC_WORKERS, thread_name_prefix="fsync")
+    
+    @contextmanager
+    def _locked_stats(self):
+        """Hold the stats lock across threads and, where flock is available, across processes"""
+        with self._stats_lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # Closing the file releases the flock
     
-    def save_uploaded_file(self, file_bytes: bytes, original_filename: str, user_id: int, building_id: int) -> Tuple[str, str]:
+    def _read_stats(self) -> Optional[Tuple[int, int]]:
+        """Totals from the sidecar file, or None if it is missing or unreadable; call with the lock held"""
+        try:
+            with open(self.stats_path) as f:
+                stats = json.load(f)
+            return int(stats["total_files"]), int(stats["total_bytes"])
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def _recompute_stats(self) -> Tuple[int, int]:
+        """Walk the tree once and persist the totals; call with the lock held"""
+        sizes = list(iter_file_sizes(self._storage_root))
+        total_files, total_bytes = len(sizes), sum(sizes)
+        self._write_stats(total_files, total_bytes)
+        return total_files, total_bytes
+    
+    def _write_stats(self, total_files: int, total_bytes: int):
+        """Persist totals atomically (write a temp file, then rename over the sidecar)"""
+        tmp_path = self.stats_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"total_files": total_files, "total_bytes": total_bytes}, f)
+        os.replace(tmp_path, self.stats_path)
+    
+    def _update_stats(self, files_delta: int, bytes_delta: int):
+        """Apply a change to the persisted totals; call with the lock held"""
+        try:
+            stats = self._read_stats()
+            if stats is None:
+                # The walk already sees the change being recorded
+                self._recompute_stats()
+            else:
+                self._write_stats(stats[0] + files_delta, stats[1] + bytes_delta)
+        except OSError as e:
+            logger.warning("Failed to persist storage stats: %s", e)
+    
+    def save_uploaded_file(self, file_obj: BinaryIO, original_filename: str, user_id: int, building_id: int) -> Tuple[str, str]:
         """
         Save uploaded file and return (file_id, file_path)
         
         Args:
-            file_bytes: Raw file content
+            file_obj: Readable binary stream with the file content
             original_filename: Original filename from upload
             user_id: User who uploaded the file
             building_id: Building the file belongs to
@@ -28,37 +174,62 @@ class FileStorageService:
             Tuple of (unique_file_id, relative_file_path)
         """
         try:
-            # Generate unique file ID
-            file_id = str(uuid.uuid4())
-            
             # Extract file extension
-            file_ext = Path(original_filename).suffix.lower()
-            if not file_ext:
-                file_ext = '.png'  # Default extension
+            file_ext = os.path.splitext(original_filename)[1].lower() or '.png'  # Default extension
             
             # Create organized directory structure: user_id/building_id/
-            user_dir = self.storage_dir / str(user_id) / str(building_id)
-            user_dir.mkdir(parents=True, exist_ok=True)
+            user_dir = os.path.join(self._storage_root, str(user_id), str(building_id))
+            os.makedirs(user_dir, exist_ok=True)
+            
+            # Write to a temporary name while hashing; the content hash becomes the file ID
+            tmp_path = os.path.join(user_dir, f".{uuid.uuid4()}.part")
+            hasher = content_hasher()
+            # Unbuffered write: no copy through Python's IO buffer
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                file_size = write_stream(fd, file_obj, hasher)
+            except BaseException:
+                os.close(fd)
+                os.unlink(tmp_path)
+                raise
+            os.close(fd)
             
-            # Create filename: file_id + original_extension
-            filename = f"{file_id}{file_ext}"
-            file_path = user_dir / filename
+            # Content file: file_id + original_extension, shared by identical uploads to this building.
+            # Each upload gets its own hard link to it, so the link count is the reference count and
+            # deleting one drawing's file never removes another's.
+            file_id = content_id(hasher)
+            file_path = os.path.join(user_dir, f"{file_id}{file_ext}")
+            filename = f"{file_id}-{uuid.uuid4().hex[:8]}{file_ext}"
             
-            # Save the file
-            with open(file_path, 'wb') as f:
-                f.write(file_bytes)
+            try:
+                with self._locked_stats():
+                    try:
+                        os.link(tmp_path, file_path)
+                        is_new = True
+                    except FileExistsError:
+                        is_new = False
+                    os.link(file_path, os.path.join(user_dir, filename))
+                    if is_new:
+                        self._update_stats(1, file_size)
+            finally:
+                os.unlink(tmp_path)
+            
+            if is_new:
+                self._fsync_pool.submit(fsync_path, file_path)
+            else:
+                logger.info("Deduplicated upload: %s -> %s", original_filename, file_path)
             
             # Return relative path for database storage
             relative_path = f"{user_id}/{building_id}/{filename}"
             
-            logger.info(f"Saved file: {original_filename} -> {relative_path}")
+            logger.info("Saved file: %s -> %s", original_filename, relative_path)
             return file_id, relative_path
             
         except Exception as e:
-            logger.error(f"Failed to save file {original_filename}: {e}")
+            logger.error("Failed to save file %s: %s", original_filename, e)
             raise
     
-    def get_file_path(self, relative_path: str) -> Optional[Path]:
+    def get_file_path(self, relative_path: str) -> Optional[str]:
         """
         Get absolute file path from relative path
         
@@ -69,16 +240,16 @@ class FileStorageService:
             Absolute path to file, or None if not found
         """
         try:
-            full_path = self.storage_dir / relative_path
+            full_path = os.path.join(self._storage_root, relative_path)
             
-            if full_path.exists() and full_path.is_file():
+            if os.path.isfile(full_path):
                 return full_path
             else:
-                logger.warning(f"File not found: {relative_path}")
+                logger.warning("File not found: %s", relative_path)
                 return None
                 
         except Exception as e:
-            logger.error(f"Error accessing file {relative_path}: {e}")
+            logger.error("Error accessing file %s: %s", relative_path, e)
             return None
     
     def delete_file(self, relative_path: str) -> bool:
@@ -92,33 +263,51 @@ class FileStorageService:
             True if deleted successfully, False otherwise
         """
         try:
-            full_path = self.storage_dir / relative_path
+            full_path = os.path.join(self._storage_root, relative_path)
             
-            if full_path.exists():
-                full_path.unlink()
-                logger.info(f"Deleted file: {relative_path}")
-                
-                # Clean up empty directories
+            building_dir = os.path.dirname(full_path)
+            content_path = os.path.join(building_dir, content_file_name(os.path.basename(full_path)))
+            
+            with self._locked_stats():
                 try:
-                    full_path.parent.rmdir()  # Remove building dir if empty
-                    full_path.parent.parent.rmdir()  # Remove user dir if empty
-                except OSError:
-                    pass  # Directories not empty, which is fine
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    logger.warning("File not found for deletion: %s", relative_path)
+                    return False
                 
-                return True
-            else:
-                logger.warning(f"File not found for deletion: {relative_path}")
-                return False
+                os.unlink(full_path)
+                links = stat.st_nlink - 1
+                if links == 1 and content_path != full_path:
+                    try:
+                        content_stat = os.stat(content_path)
+                    except FileNotFoundError:
+                        content_stat = None
+                    if content_stat is not None and content_stat.st_ino == stat.st_ino:
+                        # Only the shared content file is left, and no other upload refers to it
+                        os.unlink(content_path)
+                        links = 0
+                if links == 0:
+                    self._update_stats(-1, -stat.st_size)
+            logger.info("Deleted file: %s", relative_path)
+            
+            # Clean up empty directories
+            try:
+                os.rmdir(building_dir)  # Remove building dir if empty
+                os.rmdir(os.path.dirname(building_dir))  # Remove user dir if empty
+            except OSError:
+                pass  # Directories not empty, which is fine
+            
+            return True
                 
         except Exception as e:
-            logger.error(f"Error deleting file {relative_path}: {e}")
+            logger.error("Error deleting file %s: %s", relative_path, e)
             return False
     
     def get_storage_info(self) -> dict:
         """Get storage system information"""
         try:
-            total_files = sum(1 for _ in self.storage_dir.rglob('*') if _.is_file())
-            total_size = sum(f.stat().st_size for f in self.storage_dir.rglob('*') if f.is_file())
+            with self._locked_stats():
+                total_files, total_size = self._read_stats() or self._recompute_stats()
             
             return {
                 "storage_dir": str(self.storage_dir.absolute()),
@@ -127,8 +316,12 @@ class FileStorageService:
                 "total_size_mb": round(total_size / (1024 * 1024), 2)
             }
         except Exception as e:
-            logger.error(f"Error getting storage info: {e}")
+            logger.error("Error getting storage info: %s", e)
             return {"error": str(e)}
+    
+    def close(self):
+        """Wait for pending background fsyncs"""
+        self._fsync_pool.shutdown(wait=True)
 
 # Global file storage instance
 file_storage = FileStorageService()
\ No newline at end of file
@@ -1,16 +1,25 @@
+import hashlib
 import logging
 import uvicorn
 import os
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Depends, status
-from fastapi.responses import JSONResponse, FileResponse
+import orjson
+import tempfile
+import uuid
+from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header, status
+from fastapi.responses import ORJSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional, List
+from typing import Generator, Optional, List
+from pydantic import BaseModel, TypeAdapter
 import asyncio
+import anyio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy import select, bindparam
+from sqlalchemy.orm import Session, load_only
 
 from models import QueryRequest, QueryResponse
 from scene_graph_service import SceneGraphService
@@ -18,10 +27,11 @@ from database import db
 from config import Config
 from chat_service import chat_service, ChatMessage
 from chat_models import ChatRequest, WebSocketMessage
-from auth_models import User, UserCreate, UserResponse, BuildingCreate, BuildingResponse, DrawingCreate, DrawingResponse, Token, LoginRequest
+from auth_models import Building, Drawing, UserCreate, UserResponse, BuildingCreate, BuildingResponse, DrawingCreate, DrawingResponse, Token, LoginRequest
 from auth_service import auth_service
 from auth_database import auth_db
-from blob_storage import blob_storage
+from blob_storage import blob_storage, content_type_for
+from cache import TTLCache
 
 # Configure logging
 logging.basicConfig(
@@ -30,19 +40,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize services
-scene_service = SceneGraphService()
+# Initialize services (scene_service is created in lifespan, inside each worker process)
+scene_service: Optional[SceneGraphService] = None
 security = HTTPBearer()
 
-# Dependency to get database session
-def get_db() -> Session:
-    return next(auth_db.get_session())
+# Serialized overlay payloads keyed by (diagram_id, graph generation) -> (etag, json bytes)
+COMPONENTS_CACHE = TTLCache(maxsize=256, ttl=3600)
+
+# Image served for diagrams without a stored file; stat'ed once since it ships with the app
+FALLBACK_IMAGE_PATH = "SimpleRiser.png"
+try:
+    FALLBACK_IMAGE_STAT = os.stat(FALLBACK_IMAGE_PATH)
+except OSError:
+    FALLBACK_IMAGE_STAT = None
+
+# Locally stored images are content-addressed and never rewritten, so (path, stat) can be reused
+IMAGE_STAT_CACHE = TTLCache(maxsize=1024, ttl=300)
+
+# Configuration doesn't change while the process runs
+OPENAI_CONFIGURED = bool(Config.OPENAI_API_KEY)
+
+# List responses are validated from ORM rows and serialized in one pass each
+BUILDING_LIST_ADAPTER = TypeAdapter(List[BuildingResponse])
+DRAWING_LIST_ADAPTER = TypeAdapter(List[DrawingResponse])
+
+def json_list(adapter: TypeAdapter, rows) -> Response:
+    """Serialize ORM rows through a list adapter, bypassing FastAPI's second validation of the return value"""
+    return Response(adapter.dump_json(adapter.validate_python(rows, from_attributes=True)), media_type="application/json")
+
+def json_model(model: BaseModel) -> Response:
+    """Serialize an already-built response model once; response_model then only documents the schema"""
+    return Response(model.model_dump_json(), media_type="application/json")
+
+# Uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+async def spool_upload(file: UploadFile) -> str:
+    """Copy an upload to a temp file chunk by chunk, rejecting it as soon as it exceeds MAX_FILE_SIZE"""
+    tmp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.filename)[1].lower(), delete=False)
+    try:
+        with tmp:
+            size = 0
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > Config.MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=413, 
+                        detail=f"File too large. Maximum size: {Config.MAX_FILE_SIZE} bytes"
+                    )
+                tmp.write(chunk)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+    return tmp.name
+
+# Dependency to get database session (closed by FastAPI once the response is sent)
+def get_db() -> Generator[Session, None, None]:
+    yield from auth_db.get_session()
 
 # Dependency to get current user from JWT token
-async def get_current_user(
+def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
-) -> User:
+) -> UserResponse:
     """Get current authenticated user"""
     token = credentials.credentials
     user = auth_service.get_current_user_from_token(db, token)
@@ -56,42 +116,113 @@ async def get_current_user(
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global scene_service
+    
     # Startup
+    # Bounded pool shared by every asyncio.to_thread call, so concurrent uploads don't spawn unbounded threads
+    executor = ThreadPoolExecutor(max_workers=Config.WORKER_THREADS, thread_name_prefix="worker")
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Plain `def` endpoints run on AnyIO's thread pool; give it the same headroom
+    anyio.to_thread.current_default_thread_limiter().total_tokens = Config.SYNC_ENDPOINT_THREADS
     try:
         Config.validate()
-        db.create_schema()  # Neo4j schema
-        auth_db.create_tables()  # PostgreSQL/SQLite tables
+        scene_service = SceneGraphService()
+        # Neo4j schema and PostgreSQL/SQLite tables are independent, so create them concurrently
+        await asyncio.gather(
+            asyncio.to_thread(db.create_schema),
+            asyncio.to_thread(auth_db.create_tables)
+        )
         logger.info("Application startup completed")
     except Exception as e:
-        logger.error(f"Startup failed: {e}")
+        logger.error("Startup failed: %s", e)
         raise
     
     yield
     
     # Shutdown
+    scene_service.close()
     db.close()
+    await blob_storage.close()
+    executor.shutdown(wait=True)
     logger.info("Application shutdown completed")
 
 app = FastAPI(
     title="Engineering Scene Graph API",
     description="Extract scene graphs from engineering diagrams and query them with natural language",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+INTERNAL_ERROR_BODY = orjson.dumps({"detail": "Internal server error"})
+
+class ErrorHandlerMiddleware:
+    """Turn unhandled exceptions into a pre-serialized 500 JSON response"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        response_started = False
+        
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exc:
+            logger.error("Unhandled exception: %s", exc, exc_info=exc)
+            if response_started:
+                raise
+            await send({
+                "type": "http.response.start",
+                "status": 500,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(INTERNAL_ERROR_BODY)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": INTERNAL_ERROR_BODY})
+
+# Innermost, so error responses still pass through CORS and compression
+app.add_middleware(ErrorHandlerMiddleware)
+
 # Add CORS middleware for frontend development
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:5174", "http://localhost:3000"],  # Include Docker frontend
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,  # Browsers cache preflights for a day
 )
 
+class JSONGZipMiddleware:
+    """GZip responses except image downloads, which are already compressed (and sent with sendfile)"""
+    
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/image"):
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+# Compress JSON payloads (component lists, chat history) over 1KB
+app.add_middleware(JSONGZipMiddleware, minimum_size=1024)
+
 # ===== AUTHENTICATION ENDPOINTS =====
 
 @app.post("/auth/register", response_model=UserResponse)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+def register_user(user: UserCreate, db: Session = Depends(get_db)):
     """Register a new user"""
     try:
         new_user = auth_service.create_user(db, user)
@@ -99,11 +230,11 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Registration failed: {e}")
+        logger.error("Registration failed: %s", e)
         raise HTTPException(status_code=500, detail="Registration failed")
 
 @app.post("/auth/login", response_model=Token)
-async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
+def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     """Authenticate user and return JWT token"""
     user = auth_service.authenticate_user(db, login_data.username, login_data.password)
     if not user:
@@ -125,21 +256,25 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     )
 
 @app.get("/auth/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: UserResponse = Depends(get_current_user)):
     """Get current user information"""
-    return UserResponse.from_orm(current_user)
+    return json_model(current_user)
 
 # ===== BUILDING MANAGEMENT ENDPOINTS =====
 
+# drawing_count is a correlated subquery column on Building, so each of these is one round trip
+BUILDINGS_BY_OWNER = select(Building).where(Building.owner_user_id == bindparam("owner_id"))
+OWNED_BUILDING = BUILDINGS_BY_OWNER.where(Building.id == bindparam("building_id"))
+OWNED_BUILDING_ID = select(Building.id)\
+    .where(Building.id == bindparam("building_id"), Building.owner_user_id == bindparam("owner_id"))
+
 @app.post("/buildings", response_model=BuildingResponse)
-async def create_building(
+def create_building(
     building: BuildingCreate, 
-    current_user: User = Depends(get_current_user),
+    current_user: UserResponse = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Create a new building"""
-    from auth_models import Building
-    
     db_building = Building(
         name=building.name,
         address=building.address,
@@ -150,139 +285,120 @@ async def create_building(
     db.commit()
     db.refresh(db_building)
     
-    response = BuildingResponse.from_orm(db_building)
-    response.drawing_count = 0
-    return response
+    return BuildingResponse.from_orm(db_building)
 
 @app.get("/buildings", response_model=List[BuildingResponse])
-async def list_user_buildings(
-    current_user: User = Depends(get_current_user),
+def list_user_buildings(
+    current_user: UserResponse = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """List all buildings owned by current user"""
-    from auth_models import Building, Drawing
-    from sqlalchemy import func
+    buildings = db.scalars(BUILDINGS_BY_OWNER, {"owner_id": current_user.id}).all()
     
-    buildings = db.query(Building, func.count(Drawing.id).label('drawing_count'))\
-                  .outerjoin(Drawing)\
-                  .filter(Building.owner_user_id == current_user.id)\
-                  .group_by(Building.id)\
-                  .all()
-    
-    result = []
-    for building, drawing_count in buildings:
-        building_response = BuildingResponse.from_orm(building)
-        building_response.drawing_count = drawing_count
-        result.append(building_response)
-    
-    return result
+    return json_list(BUILDING_LIST_ADAPTER, buildings)
 
 @app.get("/buildings/{building_id}", response_model=BuildingResponse)
-async def get_building(
+def get_building(
     building_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: UserResponse = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get specific building (only if owned by current user)"""
-    from auth_models import Building, Drawing
-    from sqlalchemy import func
-    
-    building = db.query(Building)\
-                 .filter(Building.id == building_id, Building.owner_user_id == current_user.id)\
-                 .first()
+    building = db.scalars(OWNED_BUILDING, {"owner_id": current_user.id, "building_id": building_id}).first()
     
     if not building:
         raise HTTPException(status_code=404, detail="Building not found")
     
-    drawing_count = db.query(func.count(Drawing.id))\
-                      .filter(Drawing.building_id == building_id)\
-                      .scalar()
-    
-    response = BuildingResponse.from_orm(building)
-    response.drawing_count = drawing_count
-    return response
+    return json_model(BuildingResponse.model_validate(building))
 
 # ===== DRAWING MANAGEMENT ENDPOINTS =====
 
+# Ownership is checked in the same statement; an empty result needs OWNED_BUILDING_ID to tell 404 apart
+OWNED_DRAWINGS_IN_BUILDING = select(Drawing)\
+    .join(Building)\
+    .where(Drawing.building_id == bindparam("building_id"), Building.owner_user_id == bindparam("owner_id"))\
+    .order_by(Drawing.created_at.desc())
+# The image endpoint only needs the stored path and the original filename
+DRAWING_BY_SCENE_GRAPH = select(Drawing)\
+    .options(load_only(Drawing.file_path, Drawing.filename))\
+    .where(Drawing.scene_graph_id == bindparam("scene_graph_id"))\
+    .limit(1)
+OWNED_DRAWING_BY_SCENE_GRAPH = DRAWING_BY_SCENE_GRAPH\
+    .join(Building)\
+    .where(Building.owner_user_id == bindparam("owner_id"))
+
 @app.get("/buildings/{building_id}/drawings", response_model=List[DrawingResponse])
-async def list_building_drawings(
+def list_building_drawings(
     building_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: UserResponse = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """List all drawings in a building (only if user owns the building)"""
-    from auth_models import Building, Drawing
+    params = {"owner_id": current_user.id, "building_id": building_id}
+    drawings = db.scalars(OWNED_DRAWINGS_IN_BUILDING, params).all()
     
-    # Verify user owns the building
-    building = db.query(Building)\
-                 .filter(Building.id == building_id, Building.owner_user_id == current_user.id)\
-                 .first()
-    
-    if not building:
+    # No rows means either an empty building or one the user doesn't own
+    if not drawings and db.scalar(OWNED_BUILDING_ID, params) is None:
         raise HTTPException(status_code=404, detail="Building not found")
     
-    # Get drawings for this building
-    drawings = db.query(Drawing)\
-                 .filter(Drawing.building_id == building_id)\
-                 .order_by(Drawing.created_at.desc())\
-                 .all()
-    
-    return [DrawingResponse.from_orm(drawing) for drawing in drawings]
+    return json_list(DRAWING_LIST_ADAPTER, drawings)
+
+def find_upload_building(db: Session, user_id: int, building_id: Optional[int]):
+    if building_id:
+        # Use specified building if provided
+        user_building = db.scalars(OWNED_BUILDING, {"owner_id": user_id, "building_id": building_id}).first()
+        if not user_building:
+            raise HTTPException(status_code=404, detail="Building not found or not owned by user")
+    else:
+        # Fallback to user's first building
+        user_building = db.scalars(BUILDINGS_BY_OWNER, {"owner_id": user_id}).first()
+        if not user_building:
+            raise HTTPException(status_code=400, detail="No building found. Please create a building first.")
+    return user_building
+
+def save_drawing(db: Session, drawing):
+    db.add(drawing)
+    db.commit()
+    db.refresh(drawing)
 
 @app.post("/upload")
 async def upload_diagram(
     file: UploadFile = File(...),
     building_id: int = None,
-    current_user: User = Depends(get_current_user),
+    current_user: UserResponse = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Upload and process engineering diagram"""
+    upload_path = None
     try:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No filename provided")
         
-        # Read file content
-        file_bytes = await file.read()
-        
-        # Validate file size
-        config = Config()
-        if len(file_bytes) > config.MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=413, 
-                detail=f"File too large. Maximum size: {config.MAX_FILE_SIZE} bytes"
-            )
+        # Stream the upload to disk, enforcing the size limit as it arrives
+        upload_path = await spool_upload(file)
+        # Reject mislabeled files before anything is written to storage
+        await asyncio.to_thread(scene_service.doc_processor.validate_source, file.filename, upload_path)
         
-        # Get the specified building or user's first building
-        from auth_models import Building, Drawing
+        # Get the specified building or user's first building (blocking query, so off the event loop)
+        user_building = await asyncio.to_thread(find_upload_building, db, current_user.id, building_id)
         
-        if building_id:
-            # Use specified building if provided
-            user_building = db.query(Building)\
-                              .filter(Building.id == building_id, Building.owner_user_id == current_user.id)\
-                              .first()
-            if not user_building:
-                raise HTTPException(status_code=404, detail="Building not found or not owned by user")
-        else:
-            # Fallback to user's first building
-            user_building = db.query(Building)\
-                              .filter(Building.owner_user_id == current_user.id)\
-                              .first()
-            if not user_building:
-                raise HTTPException(status_code=400, detail="No building found. Please create a building first.")
-        
-        # Save the uploaded image file
-        file_id, blob_url = blob_storage.save_uploaded_file(
-            file_bytes, 
+        # Save the uploaded image file, streaming from the spooled upload
+        await file.seek(0)
+        file_id, blob_url = await blob_storage.save_uploaded_file(
+            file.file, 
             file.filename, 
             current_user.id, 
             user_building.id
         )
         
         # Process file and create scene graph
-        scene_graph = scene_service.create_scene_graph_from_file(
+        scene_graph = await asyncio.to_thread(
+            scene_service.create_scene_graph_from_file,
             file.filename, 
-            file_bytes
+            upload_path
         )
+        # Components are merged by id, so a new graph can change other diagrams' overlays too
+        COMPONENTS_CACHE.clear()
         
         # Create drawing record with file path
         drawing = Drawing(
@@ -293,10 +409,8 @@ async def upload_diagram(
             uploaded_by=current_user.id,
             file_path=blob_url
         )
-        db.add(drawing)
-        db.commit()
-        db.refresh(drawing)
-        logger.info(f"Created drawing record: {drawing.id} for building {user_building.id} with blob: {blob_url}")
+        await asyncio.to_thread(save_drawing, db, drawing)
+        logger.info("Created drawing record: %s for building %s with blob: %s", drawing.id, user_building.id, blob_url)
         
         return {
             "diagram_id": scene_graph.diagram_id,
@@ -307,78 +421,58 @@ async def upload_diagram(
             "message": "Scene graph created successfully"
         }
         
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Upload failed: {e}")
+        logger.error("Upload failed: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        if upload_path:
+            os.unlink(upload_path)
+
+# Static API description, serialized once
+ROOT_PAYLOAD = orjson.dumps({
+    "message": "Engineering Scene Graph API",
+    "version": "1.0.0",
+    "endpoints": {
+        "upload": "/upload - Upload and process engineering diagrams",
+        "query": "/query - Query scene graphs with natural language",
+        "diagrams": "/diagrams - List all processed diagrams",
+        "diagram": "/diagrams/{diagram_id} - Get diagram details",
+        "health": "/health - System health check",
+        "health_live": "/health/live - Liveness probe (no dependency checks)",
+        "health_ready": "/health/ready - Readiness probe (503 until dependencies are reachable)"
+    }
+})
 
 @app.get("/")
 async def root():
-    return {
-        "message": "Engineering Scene Graph API",
-        "version": "1.0.0",
-        "endpoints": {
-            "upload": "/upload - Upload and process engineering diagrams",
-            "query": "/query - Query scene graphs with natural language",
-            "diagrams": "/diagrams - List all processed diagrams",
-            "diagram": "/diagrams/{diagram_id} - Get diagram details",
-            "health": "/health - System health check"
-        }
-    }
+    return Response(ROOT_PAYLOAD, media_type="application/json")
 
-@app.post("/upload")
-async def upload_diagram(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
-):
-    try:
-        if not file.filename:
-            raise HTTPException(status_code=400, detail="No filename provided")
-        
-        # Read file content
-        file_bytes = await file.read()
-        
-        # Validate file size
-        if len(file_bytes) > Config.MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=413, 
-                detail=f"File too large. Maximum size: {Config.MAX_FILE_SIZE} bytes"
-            )
-        
-        # Process file and create scene graph
-        scene_graph = scene_service.create_scene_graph_from_file(
-            file.filename, 
-            file_bytes
-        )
-        
-        return {
-            "diagram_id": scene_graph.diagram_id,
-            "title": scene_graph.title,
-            "components_count": len(scene_graph.nodes),
-            "relationships_count": len(scene_graph.relationships),
-            "metadata": scene_graph.metadata,
-            "message": "Scene graph created successfully"
-        }
-        
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        logger.error(f"Upload failed: {e}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+# Constant WebSocket frames, serialized once
+WS_STATUS_PROCESSING = WebSocketMessage(type="status", content="Processing your question...").model_dump_json()
+WS_QUERY_ERROR = WebSocketMessage(
+    type="error",
+    content="Sorry, I encountered an error processing your question."
+).model_dump_json()
 
 # New WebSocket endpoint for streaming chat
 @app.websocket("/ws/chat/{diagram_id}")
 async def websocket_chat(websocket: WebSocket, diagram_id: str):
     await websocket.accept()
+    # Up to WS_MAX_INFLIGHT questions from this socket are answered at once
+    inflight = asyncio.Semaphore(Config.WS_MAX_INFLIGHT)
+    tasks = set()
     try:
         while True:
             # Receive message from client
             data = await websocket.receive_text()
             
-            # Save user message to chat history
-            user_message = ChatMessage(
-                id=chat_service.create_message_id(),
+            # Save user message to chat history (built by the handler, so skip validation)
+            user_message = ChatMessage.model_construct(
+                id=str(uuid.uuid4()),
                 diagram_id=diagram_id,
                 role="user",
                 content=data,
@@ -387,66 +481,76 @@ async def websocket_chat(websocket: WebSocket, diagram_id: str):
             chat_service.save_message(user_message)
             
             # Send status message
-            await websocket.send_text(WebSocketMessage(
-                type="status",
-                content="Processing your question..."
-            ).model_dump_json())
+            await websocket.send_text(WS_STATUS_PROCESSING)
             
-            try:
-                # Get response from scene graph service
-                result = scene_service.query_scene_graphs(data, diagram_id)
-                
-                # Save assistant message
-                assistant_message = ChatMessage(
-                    id=chat_service.create_message_id(),
-                    diagram_id=diagram_id,
-                    role="assistant", 
-                    content=result['answer'],
-                    timestamp=datetime.now(),
-                    confidence=result['confidence']
-                )
-                chat_service.save_message(assistant_message)
-                
-                # Send the response
-                await websocket.send_text(WebSocketMessage(
-                    type="message",
-                    content=result['answer'],
-                    message_id=assistant_message.id
-                ).model_dump_json())
-                
-            except Exception as e:
-                logger.error(f"Query processing error: {e}")
-                await websocket.send_text(WebSocketMessage(
-                    type="error",
-                    content="Sorry, I encountered an error processing your question."
-                ).model_dump_json())
+            # Back-pressure: stop reading new questions while the limit is reached
+            await inflight.acquire()
+            task = asyncio.create_task(answer_chat_question(websocket, diagram_id, data, inflight))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
                 
     except WebSocketDisconnect:
-        logger.info(f"WebSocket disconnected for diagram {diagram_id}")
+        logger.info("WebSocket disconnected for diagram %s", diagram_id)
+    finally:
+        # Let in-flight answers finish so they are still saved to history
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+async def answer_chat_question(websocket: WebSocket, diagram_id: str, question: str, inflight: asyncio.Semaphore):
+    try:
+        try:
+            # Get response from scene graph service
+            result = await asyncio.to_thread(scene_service.query_scene_graphs, question, diagram_id)
+        except Exception as e:
+            logger.error("Query processing error: %s", e)
+            await websocket.send_text(WS_QUERY_ERROR)
+            return
+        
+        # Save assistant message
+        assistant_message = ChatMessage.model_construct(
+            id=str(uuid.uuid4()),
+            diagram_id=diagram_id,
+            role="assistant", 
+            content=result['answer'],
+            timestamp=datetime.now(),
+            confidence=result['confidence']
+        )
+        chat_service.save_message(assistant_message)
+        
+        # Send the response (fields are already known-good, so skip validation)
+        await websocket.send_text(WebSocketMessage.model_construct(
+            type="message",
+            content=result['answer'],
+            message_id=assistant_message.id
+        ).model_dump_json())
+    finally:
+        inflight.release()
 
 # Chat history endpoints
 @app.get("/api/chat/history/{diagram_id}")
-async def get_chat_history(diagram_id: str):
+async def get_chat_history(diagram_id: str, limit: int = 50):
     try:
-        messages = chat_service.get_chat_history(diagram_id)
-        return {
+        messages = await asyncio.to_thread(chat_service.get_chat_history, diagram_id, limit)
+        # Serialized in one pass; orjson writes the datetimes itself
+        payload = orjson.dumps({
             "messages": [
                 {
                     "id": msg.id,
                     "role": msg.role,
                     "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat(),
+                    "timestamp": msg.timestamp,
                     "confidence": msg.confidence
                 }
                 for msg in messages
             ]
-        }
+        })
+        return Response(payload, media_type="application/json")
     except Exception as e:
-        logger.error(f"Failed to get chat history: {e}")
+        logger.error("Failed to get chat history: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/chat/clear/{diagram_id}")
-async def clear_chat_history(diagram_id: str):
+def clear_chat_history(diagram_id: str):
     try:
         success = chat_service.clear_chat_history(diagram_id)
         if success:
@@ -454,12 +558,12 @@ async def clear_chat_history(diagram_id: str):
         else:
             raise HTTPException(status_code=500, detail="Failed to clear chat history")
     except Exception as e:
-        logger.error(f"Failed to clear chat history: {e}")
+        logger.error("Failed to clear chat history: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # Serve diagram images
 @app.get("/diagrams/{diagram_id}/image")
-async def get_diagram_image(
+def get_diagram_image(
     diagram_id: str,
     token: Optional[str] = None,
     db: Session = Depends(get_db)
@@ -471,28 +575,20 @@ async def get_diagram_image(
             current_user = auth_service.get_current_user_from_token(db, token)
         
         # Find the drawing record with this scene_graph_id
-        from auth_models import Drawing, Building
-        
         if current_user:
             # Authenticated request - check ownership
-            drawing = db.query(Drawing)\
-                        .join(Building)\
-                        .filter(
-                            Drawing.scene_graph_id == diagram_id,
-                            Building.owner_user_id == current_user.id
-                        )\
-                        .first()
+            drawing = db.scalars(
+                OWNED_DRAWING_BY_SCENE_GRAPH,
+                {"scene_graph_id": diagram_id, "owner_id": current_user.id}
+            ).first()
         else:
             # Unauthenticated request - allow any drawing for now (public access)
-            drawing = db.query(Drawing)\
-                        .filter(Drawing.scene_graph_id == diagram_id)\
-                        .first()
+            drawing = db.scalars(DRAWING_BY_SCENE_GRAPH, {"scene_graph_id": diagram_id}).first()
         
         if not drawing or not drawing.file_path:
             # Fallback to SimpleRiser.png for existing diagrams without file_path
-            fallback_path = "SimpleRiser.png"
-            if os.path.exists(fallback_path):
-                return FileResponse(fallback_path, media_type="image/png")
+            if FALLBACK_IMAGE_STAT:
+                return FileResponse(FALLBACK_IMAGE_PATH, media_type="image/png", stat_result=FALLBACK_IMAGE_STAT)
             else:
                 raise HTTPException(status_code=404, detail="Diagram image not found")
         
@@ -502,82 +598,71 @@ async def get_diagram_image(
                 # Stream from Azure Blob Storage
                 blob_client = blob_storage.blob_service_client.get_blob_client(
                     container=blob_storage.container_name,
-                    blob=drawing.file_path.replace(f"https://{blob_storage.account_name}.blob.core.windows.net/{blob_storage.container_name}/", "")
+                    blob=blob_storage.blob_name(drawing.file_path)
                 )
                 
-                # Download blob content
-                blob_data = blob_client.download_blob().readall()
+                # Download in chunks, forwarding each one as it arrives
+                downloader = blob_client.download_blob(max_concurrency=2)
                 
                 # Determine content type from file extension
-                file_ext = os.path.splitext(drawing.filename)[1].lower()
-                content_type_map = {
-                    '.png': 'image/png',
-                    '.jpg': 'image/jpeg', 
-                    '.jpeg': 'image/jpeg',
-                    '.pdf': 'application/pdf'
-                }
-                content_type = content_type_map.get(file_ext, 'application/octet-stream')
+                content_type = content_type_for(drawing.filename)
                 
-                # Return blob content directly
-                from fastapi.responses import Response
-                return Response(content=blob_data, media_type=content_type)
+                return StreamingResponse(
+                    downloader.chunks(),
+                    media_type=content_type,
+                    headers={"Content-Length": str(downloader.size)}
+                )
             else:
                 # Local storage fallback
-                from file_storage import file_storage
-                file_path = file_storage.get_file_path(drawing.file_path)
-                if file_path and file_path.exists():
-                    return FileResponse(str(file_path))
-                else:
-                    raise HTTPException(status_code=404, detail="Image file not found")
+                cached = IMAGE_STAT_CACHE.get(drawing.file_path)
+                if cached is None:
+                    from file_storage import file_storage
+                    file_path = file_storage.get_file_path(drawing.file_path)
+                    if not file_path:
+                        raise HTTPException(status_code=404, detail="Image file not found")
+                    cached = (file_path, os.stat(file_path))
+                    IMAGE_STAT_CACHE.set(drawing.file_path, cached)
+                
+                # With a stat_result, FileResponse skips its own stat and goes straight to sending the file
+                file_path, stat_result = cached
+                return FileResponse(file_path, stat_result=stat_result)
                     
         except Exception as e:
-            logger.error(f"Error streaming blob content: {e}")
+            logger.error("Error streaming blob content: %s", e)
             raise HTTPException(status_code=404, detail="Image file not found")
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to serve diagram image: {e}")
+        logger.error("Failed to serve diagram image: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # Get components for diagram overlay
 @app.get("/api/diagrams/{diagram_id}/components")
-async def get_diagram_components(diagram_id: str):
+async def get_diagram_components(diagram_id: str, if_none_match: Optional[str] = Header(None)):
     try:
-        # Get the complete scene graph data
-        graph_data = scene_service._get_complete_scene_graph(diagram_id)
-        if not graph_data:
-            raise HTTPException(status_code=404, detail="Diagram not found")
+        # Keyed by graph generation, so an ingest on any worker retires every worker's entries
+        if scene_service.generation_check_due():
+            await asyncio.to_thread(scene_service.check_generation)
+        cache_key = (diagram_id, scene_service.generation)
+        cached = COMPONENTS_CACHE.get(cache_key)
+        if cached is None:
+            payload = await asyncio.to_thread(scene_service.get_components_payload, diagram_id)
+            if payload is None:
+                raise HTTPException(status_code=404, detail="Diagram not found")
+            # Weak validator: GZip middleware may re-encode the body, so it is not byte-identical
+            cached = (f'W/"{hashlib.blake2b(payload, digest_size=8).hexdigest()}"', payload)
+            COMPONENTS_CACHE.set(cache_key, cached)
         
-        # Extract and format component data for frontend
-        components = []
-        for i, component in enumerate(graph_data['components']):
-            components.append({
-                'id': component['id'],
-                'badge_number': i + 1,  # 1-indexed badges
-                'name': component['name'],
-                'type': component['type'],
-                'position': {
-                    'x': component.get('position_x', 0) or 0,
-                    'y': component.get('position_y', 0) or 0
-                },
-                'properties': {
-                    'material': component.get('material', ''),
-                    'diameter': component.get('diameter', ''),
-                    'flow_direction': component.get('flow_direction', '')
-                }
-            })
-        
-        return {
-            'diagram_id': diagram_id,
-            'components': components,
-            'total_components': len(components)
-        }
+        etag, payload = cached
+        if if_none_match and etag[2:] in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(payload, media_type="application/json", headers={"ETag": etag})
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to get diagram components: {e}")
+        logger.error("Failed to get diagram components: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/query", response_model=QueryResponse)
@@ -586,7 +671,8 @@ async def query_diagrams(request: QueryRequest):
         if not request.question.strip():
             raise HTTPException(status_code=400, detail="Question cannot be empty")
         
-        result = scene_service.query_scene_graphs(
+        result = await asyncio.to_thread(
+            scene_service.query_scene_graphs,
             request.question,
             request.graph_id
         )
@@ -599,25 +685,25 @@ async def query_diagrams(request: QueryRequest):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Query failed: {e}")
+        logger.error("Query failed: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/diagrams")
 async def list_diagrams():
     try:
-        diagrams = scene_service.list_all_diagrams()
+        diagrams = await asyncio.to_thread(scene_service.list_all_diagrams)
         return {
             "diagrams": diagrams,
             "count": len(diagrams)
         }
     except Exception as e:
-        logger.error(f"Failed to list diagrams: {e}")
+        logger.error("Failed to list diagrams: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/diagrams/{diagram_id}")
 async def get_diagram(diagram_id: str):
     try:
-        diagram_info = scene_service.get_diagram_summary(diagram_id)
+        diagram_info = await asyncio.to_thread(scene_service.get_diagram_summary, diagram_id)
         if not diagram_info:
             raise HTTPException(status_code=404, detail="Diagram not found")
         
@@ -626,17 +712,17 @@ async def get_diagram(diagram_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to get diagram: {e}")
+        logger.error("Failed to get diagram: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/health")
-async def health_check():
+def health_check():
     try:
         # Check database connection
         db_healthy = db.health_check()
         
         # Check OpenAI API (basic validation)
-        openai_healthy = bool(Config.OPENAI_API_KEY)
+        openai_healthy = OPENAI_CONFIGURED
         
         status = "healthy" if db_healthy and openai_healthy else "unhealthy"
         
@@ -648,8 +734,8 @@ async def health_check():
         }
         
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return JSONResponse(
+        logger.error("Health check failed: %s", e)
+        return ORJSONResponse(
             status_code=503,
             content={
                 "status": "unhealthy",
@@ -657,19 +743,32 @@ async def health_check():
             }
         )
 
-@app.exception_handler(Exception)
-async def global_exception_handler(request, exc):
-    logger.error(f"Unhandled exception: {exc}")
-    return JSONResponse(
-        status_code=500,
-        content={"detail": "Internal server error"}
-    )
+# Liveness only proves the process serves requests; it never touches a dependency
+LIVE_PAYLOAD = orjson.dumps({"status": "alive"})
+
+@app.get("/health/live")
+async def liveness_check():
+    return Response(LIVE_PAYLOAD, media_type="application/json")
+
+@app.get("/health/ready")
+def readiness_check():
+    """Same report as /health, but with a 503 while not ready so probes take the pod out of rotation"""
+    result = health_check()
+    if isinstance(result, dict) and result["status"] != "healthy":
+        return ORJSONResponse(status_code=503, content=result)
+    return result
 
 if __name__ == "__main__":
+    # Reload only works with a single process, so it's limited to DEV=1
+    dev = os.getenv("DEV") == "1"
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        reload=dev,
+        workers=1 if dev else int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        ws_max_size=Config.WS_MAX_MESSAGE_SIZE,
         log_level="info"
     )
\ No newline at end of file
@@ -1,7 +1,10 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Dict, Optional, Any
 from enum import Enum
 
+# Scene graphs are built once per upload and only read afterwards
+SCENE_GRAPH_CONFIG = ConfigDict(frozen=True, extra='ignore')
+
 class ComponentType(str, Enum):
     PIPE = "pipe"
     FIXTURE = "fixture"
@@ -20,6 +23,8 @@ class RelationshipType(str, Enum):
     PARALLEL_TO = "PARALLEL_TO"
 
 class SceneGraphNode(BaseModel):
+    model_config = SCENE_GRAPH_CONFIG
+    
     id: str
     type: ComponentType
     name: str
@@ -28,12 +33,16 @@ class SceneGraphNode(BaseModel):
     dimensions: Optional[Dict[str, float]] = None  # width, height, length
 
 class SceneGraphRelationship(BaseModel):
+    model_config = SCENE_GRAPH_CONFIG
+    
     source_id: str
     target_id: str
     type: RelationshipType
     properties: Optional[Dict[str, Any]] = None
 
 class SceneGraph(BaseModel):
+    model_config = SCENE_GRAPH_CONFIG
+    
     diagram_id: str
     title: Optional[str] = None
     nodes: List[SceneGraphNode]
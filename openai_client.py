@@ -1,22 +1,14 @@
-import json
 import logging
-from typing import Optional, Dict, Any
-from openai import OpenAI
+import orjson
+from typing import Optional, Dict, Any, List
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 from config import Config
 
 logger = logging.getLogger(__name__)
 
-class OpenAIClient:
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=Config.OPENAI_API_KEY,
-            base_url="https://api.openai.com/v1"
-        )
-        self.gpt5_model = Config.GPT5_MODEL
-        self.gpt4o_mini_model = Config.GPT4O_MINI_MODEL
-    
-    def analyze_diagram_with_gpt5(self, image_base64: str, text_content: Optional[str] = None) -> Dict[str, Any]:
-        system_prompt = """You are an expert in analyzing engineering diagrams and creating scene graphs. 
+# System prompts are constant and sent first, so OpenAI's prompt caching can reuse the prefix
+DIAGRAM_SYSTEM_PROMPT = """You are an expert in analyzing engineering diagrams and creating scene graphs. 
         Your task is to extract a comprehensive scene graph from the provided engineering diagram.
         
         Analyze the diagram and identify:
@@ -60,144 +52,138 @@ class OpenAIClient:
         }
         
         Be thorough and precise. Include all visible components and their relationships."""
+
+QA_SYSTEM_PROMPT = """You are an expert engineer analyzing scene graphs from engineering diagrams.
         
+        You will receive complete scene graph data including components and relationships.
+        Analyze this data and answer questions about the engineering system.
+        
+        Provide detailed, technical answers that demonstrate understanding of:
+        - System topology and connections
+        - Material properties and specifications  
+        - Spatial relationships and flow patterns
+        - Potential failure modes and impacts
+        
+        Always explain your reasoning and cite specific components when relevant."""
+
+# Appended after the graph data, so batched and single questions share the cached prefix
+BATCH_QA_INSTRUCTIONS = """Answer each of the numbered questions below using the scene graph data above.
+Return a JSON object of the form {"answers": [{"answer": "...", "confidence": 0.0}]} with exactly one entry
+per question, in the same order. Each answer may use markdown; confidence is between 0 and 1."""
+
+# Requests made for one diagram when the model replies with empty content
+ANALYSIS_ATTEMPTS = 2
+
+# Requests sharing a key are routed together, improving prefix cache hits
+DIAGRAM_PROMPT_CACHE_KEY = "diagram_analysis_v1"
+
+def image_data_url(image_base64: bytes) -> str:
+    """Build a data URL, detecting JPEG vs PNG from the base64-encoded magic bytes"""
+    media_type = b"image/jpeg" if image_base64.startswith(b"/9j/") else b"image/png"
+    return (b"data:" + media_type + b";base64," + image_base64).decode('ascii')
+
+class OpenAIClient:
+    def __init__(self):
+        # One pooled HTTP/2 client per process; every call runs on the worker pool, so size it to match
+        self.client = OpenAI(
+            api_key=Config.OPENAI_API_KEY,
+            base_url="https://api.openai.com/v1",
+            http_client=DefaultHttpxClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=Config.WORKER_THREADS,
+                    max_keepalive_connections=Config.WORKER_THREADS
+                )
+            )
+        )
+        self.gpt5_model = Config.GPT5_MODEL
+        self.gpt4o_mini_model = Config.GPT4O_MINI_MODEL
+    
+    def close(self):
+        """Close pooled connections"""
+        self.client.close()
+    
+    def analyze_diagram_with_gpt5(self, image_base64: bytes, text_content: Optional[str] = None) -> Dict[str, Any]:
         user_prompt = "Analyze this engineering diagram and create a comprehensive scene graph as specified."
         if text_content:
             user_prompt += f"\n\nAdditional text content extracted from document:\n{text_content[:1000]}"
         
         try:
-            logger.info(f"Making GPT-5 request with model: {self.gpt5_model}")
-            logger.info(f"Image data length: {len(image_base64)} characters")
-            
-            response = self.client.chat.completions.create(
-                model=self.gpt5_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": user_prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                temperature=0.1,
-                max_completion_tokens=4000
-            )
-            
-            content = response.choices[0].message.content
-            
-            # Check if content is None or empty
-            if not content:
-                logger.error("GPT-5 returned empty content, trying with simpler prompt")
-                # Try with a simpler, more direct prompt
-                simple_response = self.client.chat.completions.create(
-                    model="gpt-4o",  # Fallback to GPT-4o
-                    messages=[
-                        {"role": "system", "content": "You are an expert in analyzing engineering diagrams. Extract key components and relationships in simple JSON format."},
+            logger.info("Making GPT-5 request with model: %s", self.gpt5_model)
+            logger.debug("Image data length: %d characters", len(image_base64))
+            messages = [
+                {"role": "system", "content": DIAGRAM_SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": user_prompt},
                         {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": "Analyze this plumbing diagram and list the main components with their connections in JSON format."},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{image_base64}",
-                                        "detail": "low"  # Use lower detail for fallback
-                                    }
-                                }
-                            ]
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_data_url(image_base64),
+                                "detail": "high"
+                            }
                         }
-                    ],
+                    ]
+                }
+            ]
+            
+            # JSON mode, so the reply is a bare JSON object; the SDK itself retries
+            # rate limits, timeouts and 5xx with backoff, so only an empty reply is retried here
+            content = None
+            for attempt in range(ANALYSIS_ATTEMPTS):
+                response = self.client.chat.completions.create(
+                    model=self.gpt5_model,
+                    messages=messages,
                     temperature=0.1,
-                    max_completion_tokens=2000
+                    max_completion_tokens=4000,
+                    response_format={"type": "json_object"},
+                    prompt_cache_key=DIAGRAM_PROMPT_CACHE_KEY
                 )
-                content = simple_response.choices[0].message.content
-                if not content:
-                    raise ValueError("Both GPT-5 and GPT-4o returned empty responses")
+                content = response.choices[0].message.content
+                if content:
+                    break
+                logger.warning("GPT-5 returned empty content (attempt %d of %d)", attempt + 1, ANALYSIS_ATTEMPTS)
+            if not content:
+                raise ValueError("GPT-5 returned empty responses")
             
-            logger.info(f"Raw GPT-5 response length: {len(content)} characters")
-            logger.info(f"Raw GPT-5 response preview: {content[:200]}...")
+            logger.info("Raw GPT-5 response length: %d characters", len(content))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Raw GPT-5 response preview: %s...", content[:200])
             
-            # Parse JSON response
             try:
-                # Try to extract JSON from response if wrapped in markdown
-                if "```json" in content.lower():
-                    json_start = content.lower().find("```json") + 7
-                    json_end = content.find("```", json_start)
-                    if json_end == -1:
-                        # No closing ```, take rest of content
-                        json_content = content[json_start:].strip()
-                    else:
-                        json_content = content[json_start:json_end].strip()
-                    
-                    logger.info(f"Extracted JSON from markdown: {len(json_content)} chars")
-                    scene_data = json.loads(json_content)
-                    
-                elif "```" in content:
-                    # Handle case where it's wrapped in code blocks without json tag
-                    json_start = content.find("```") + 3
-                    json_end = content.rfind("```")
-                    if json_end == -1 or json_end <= json_start:
-                        # No closing ```, take rest of content
-                        json_content = content[json_start:].strip()
-                    else:
-                        json_content = content[json_start:json_end].strip()
-                    
-                    logger.info(f"Extracted JSON from code block: {len(json_content)} chars")
-                    scene_data = json.loads(json_content)
-                    
-                else:
-                    # Try direct parsing
-                    logger.info("Attempting direct JSON parsing")
-                    scene_data = json.loads(content.strip())
-                
-                logger.info(f"GPT-5 analysis completed: {len(scene_data.get('components', []))} components")
+                scene_data = orjson.loads(content)
+                logger.info("GPT-5 analysis completed: %d components", len(scene_data.get('components', [])))
                 return scene_data
                 
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse GPT-5 JSON response: {e}")
-                logger.error(f"Full content ({len(content)} chars): {content}")
-                logger.error(f"Attempted to parse: {json_content if 'json_content' in locals() else 'direct content'}")
+            except orjson.JSONDecodeError as e:
+                logger.error("Failed to parse GPT-5 JSON response: %s", e)
+                # The ends of the response are enough to see truncation or stray prose
+                logger.error("Response (%d chars) starts: %s ... ends: %s", len(content), content[:500], content[-500:])
                 raise ValueError(f"Could not parse JSON from GPT-5 response: {e}")
                 
         except Exception as e:
-            logger.error(f"GPT-5 analysis failed: {e}")
+            logger.error("GPT-5 analysis failed: %s", e)
             raise
     
-    def answer_question_with_graph_context(self, question: str, graph_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Answer questions about engineering diagrams using complete graph context"""
+    def answer_question_with_graph_context(self, question: str, graph_json: str, diagram_id: str) -> Dict[str, Any]:
+        """Answer questions about engineering diagrams using complete graph context
         
-        system_prompt = """You are an expert engineer analyzing scene graphs from engineering diagrams.
-        
-        You will receive complete scene graph data including components and relationships.
-        Analyze this data and answer questions about the engineering system.
-        
-        Provide detailed, technical answers that demonstrate understanding of:
-        - System topology and connections
-        - Material properties and specifications  
-        - Spatial relationships and flow patterns
-        - Potential failure modes and impacts
-        
-        Always explain your reasoning and cite specific components when relevant."""
-        
-        user_prompt = f"Question: {question}\n\nComplete Scene Graph Data:\n{json.dumps(graph_data, indent=2)}"
+        graph_json is the diagram's scene graph, already serialized by the caller.
+        """
+        # Graph data before the question, so repeated questions about one diagram share a cached prefix
+        user_prompt = f"Complete Scene Graph Data:\n{graph_json}\n\nQuestion: {question}"
         
         try:
             response = self.client.chat.completions.create(
                 model=self.gpt4o_mini_model,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": QA_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.1,
-                max_completion_tokens=2000
+                max_completion_tokens=2000,
+                prompt_cache_key=f"qa::{diagram_id}"
             )
             
             content = response.choices[0].message.content
@@ -209,5 +195,39 @@ class OpenAIClient:
             }
                 
         except Exception as e:
-            logger.error(f"Question answering failed: {e}")
-            raise
\ No newline at end of file
+            logger.error("Question answering failed: %s", e)
+            raise
+    
+    def answer_questions_batch(self, questions: List[str], graph_json: str, diagram_id: str) -> List[Dict[str, Any]]:
+        """Answer several questions about one diagram in a single request, sending the graph context once"""
+        numbered = "\n".join(f"{i}. {question}" for i, question in enumerate(questions, 1))
+        user_prompt = f"Complete Scene Graph Data:\n{graph_json}\n\n{BATCH_QA_INSTRUCTIONS}\n\nQuestions:\n{numbered}"
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=self.gpt4o_mini_model,
+                messages=[
+                    {"role": "system", "content": QA_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.1,
+                max_completion_tokens=min(16000, 2000 * len(questions)),
+                response_format={"type": "json_object"},
+                prompt_cache_key=f"qa::{diagram_id}"
+            )
+            
+            answers = orjson.loads(response.choices[0].message.content).get("answers", [])
+            if len(answers) != len(questions):
+                raise ValueError(f"Expected {len(questions)} answers, got {len(answers)}")
+            
+            return [
+                {
+                    "answer": answer.get("answer", ""),
+                    "confidence": float(answer.get("confidence", 0.9))
+                }
+                for answer in answers
+            ]
+                
+        except Exception as e:
+            logger.error("Batch question answering failed: %s", e)
+            raise
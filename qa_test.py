@@ -65,22 +65,25 @@ def test_qa_with_existing_graph():
         
         print(f"\n🧪 Testing {len(test_questions)} natural language queries...\n")
         
+        # The graph context is sent once per batch of questions rather than once per question
+        try:
+            outcomes = [(result, None) for result in service.query_scene_graphs_batch(test_questions, diagram_id)]
+        except Exception as e:
+            outcomes = [(None, e)] * len(test_questions)
+        
         successful_queries = 0
         
-        for i, question in enumerate(test_questions, 1):
+        for i, (question, (result, error)) in enumerate(zip(test_questions, outcomes), 1):
             print(f"[{i:2d}/{len(test_questions)}] Q: {question}")
             
-            try:
-                result = service.query_scene_graphs(question, diagram_id)
-                
+            if error is None:
                 print(f"       A: {result['answer']}")
                 print(f"       Confidence: {result['confidence']:.2f}")
                 
                 successful_queries += 1
                 print("       ✅ Success\n")
-                
-            except Exception as e:
-                print(f"       ❌ Error: {e}\n")
+            else:
+                print(f"       ❌ Error: {error}\n")
         
         # Summary
         success_rate = (successful_queries / len(test_questions)) * 100
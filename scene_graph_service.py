@@ -1,22 +1,118 @@
 import logging
+import re
+import threading
+import time
+from collections import Counter
 import uuid
-from typing import Optional, List, Dict, Any
+import orjson
+from typing import Optional, List, Dict, Any, Union
 from models import SceneGraph, SceneGraphNode, SceneGraphRelationship, ComponentType, RelationshipType
 from openai_client import OpenAIClient
 from document_processor import DocumentProcessor
 from database import db
+from cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Answers are reused for repeated questions about the same diagram
+QUERY_CACHE_SIZE = 2048
+QUERY_CACHE_TTL = 600  # seconds
+
+# Model output is matched against these, so unknown types are skipped without raising
+COMPONENT_TYPES = {member.value: member for member in ComponentType}
+RELATIONSHIP_TYPES = {member.value: member for member in RelationshipType}
+
+# Questions answered per request by query_scene_graphs_batch
+QA_BATCH_SIZE = 10
+
+# Assembled graph context per diagram, so follow-up questions skip Neo4j
+GRAPH_CACHE_SIZE = 128
+
+# Seconds between checks of the stored graph generation; bounds how long another worker's
+# ingest can leave this worker's caches stale
+GENERATION_CHECK_INTERVAL = 2.0
+
+def normalize_question(question: str) -> str:
+    """Collapse whitespace and case so trivially different phrasings share a cache entry"""
+    return " ".join(question.split()).lower()
+
+def without_empty(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop None/'' values, which only add prompt tokens"""
+    return {key: value for key, value in row.items() if value is not None and value != ""}
+
+def answer_component_count(graph_data: Dict[str, Any]) -> Optional[str]:
+    components = graph_data['components']
+    by_type = Counter(component.get('type') or 'unknown' for component in components)
+    lines = [f"This diagram contains **{len(components)}** components:"]
+    lines.extend(f"- {component_type}: {count}" for component_type, count in by_type.most_common())
+    return "\n".join(lines)
+
+def answer_pipe_diameters(graph_data: Dict[str, Any]) -> Optional[str]:
+    diameters = sorted({
+        str(component['diameter']) for component in graph_data['components']
+        if component.get('type') == 'pipe' and component.get('diameter') not in (None, "")
+    })
+    if not diameters:
+        # Nothing recorded; let the model look at the graph instead
+        return None
+    return "Pipe diameters recorded in this system:\n" + "\n".join(f"- {diameter}" for diameter in diameters)
+
+# Questions with an exact answer in the graph data, matched against the normalized question
+STRUCTURED_QUESTIONS = (
+    (re.compile(r"how many components (?:are )?(?:in|does) (?:this|the) (?:\w+ )?(?:system|diagram)(?: have| contain)?\??"),
+     answer_component_count),
+    (re.compile(r"what (?:are|is) the pipe diameters? (?:used )?in (?:this|the) (?:\w+ )?(?:system|diagram)\??"),
+     answer_pipe_diameters),
+)
+
+def format_components(diagram_id: str, components: List[Dict[str, Any]]) -> bytes:
+    """Serialize component rows (as returned by the components query) for the frontend overlay"""
+    return orjson.dumps({
+        'diagram_id': diagram_id,
+        'components': [
+            {
+                'id': component['id'],
+                'badge_number': i,  # 1-indexed badges
+                'name': component['name'],
+                'type': component['type'],
+                'position': {
+                    'x': component.get('position_x', 0) or 0,
+                    'y': component.get('position_y', 0) or 0
+                },
+                'properties': {
+                    'material': component.get('material', ''),
+                    'diameter': component.get('diameter', ''),
+                    'flow_direction': component.get('flow_direction', '')
+                }
+            }
+            for i, component in enumerate(components, 1)
+        ],
+        'total_components': len(components)
+    })
+
 class SceneGraphService:
     def __init__(self):
         self.openai_client = OpenAIClient()
         self.doc_processor = DocumentProcessor()
+        # These three are cleared whenever a scene graph is stored, since components are merged
+        # by id and a new diagram can change existing diagrams' graphs
+        self.answer_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+        self.graph_cache = TTLCache(maxsize=GRAPH_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+        # The same graphs rendered as compact JSON for the QA prompt
+        self.context_cache = TTLCache(maxsize=GRAPH_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+        # Caches are per process, so stores by other workers are noticed through the generation counter
+        self.generation: Optional[int] = None
+        self._generation_checked_at = float('-inf')
+        self._generation_lock = threading.Lock()
+    
+    def close(self):
+        self.openai_client.close()
     
-    def create_scene_graph_from_file(self, filename: str, file_bytes: bytes) -> SceneGraph:
+    def create_scene_graph_from_file(self, filename: str, file_source: Union[bytes, str]) -> SceneGraph:
+        """file_source is the file content, or the path of a file holding it"""
         try:
             # Process the file
-            image_b64, text_content = self.doc_processor.process_file(filename, file_bytes)
+            image_b64, text_content = self.doc_processor.process_file(filename, file_source)
             
             # Analyze with GPT-5
             scene_data = self.openai_client.analyze_diagram_with_gpt5(image_b64, text_content)
@@ -28,6 +124,7 @@ class SceneGraphService:
             success = db.store_scene_graph(scene_graph)
             if not success:
                 raise Exception("Failed to store scene graph in database")
+            self._clear_caches()
             
             logger.info(f"Scene graph created for {filename}: {len(scene_graph.nodes)} nodes, {len(scene_graph.relationships)} relationships")
             
@@ -37,16 +134,43 @@ class SceneGraphService:
             logger.error(f"Failed to create scene graph: {e}")
             raise
     
+    def _clear_caches(self):
+        self.answer_cache.clear()
+        self.graph_cache.clear()
+        self.context_cache.clear()
+    
+    def generation_check_due(self) -> bool:
+        return time.monotonic() - self._generation_checked_at >= GENERATION_CHECK_INTERVAL
+    
+    def check_generation(self) -> Optional[int]:
+        """Re-read the stored graph generation when due, dropping the caches if any worker stored
+        a scene graph since the last check"""
+        if not self.generation_check_due():
+            return self.generation
+        with self._generation_lock:
+            if self.generation_check_due():
+                generation = db.get_graph_generation()
+                if generation is not None and generation != self.generation:
+                    self._clear_caches()
+                    self.generation = generation
+                self._generation_checked_at = time.monotonic()
+        return self.generation
+    
     def _convert_to_scene_graph(self, scene_data: Dict[str, Any], filename: str) -> SceneGraph:
         diagram_id = str(uuid.uuid4())
         
         # Convert components to nodes
         nodes = []
-        for comp_data in scene_data.get('components', []):
+        for i, comp_data in enumerate(scene_data.get('components', [])):
+            component_type = COMPONENT_TYPES.get(comp_data.get('type', 'pipe'))
+            if component_type is None:
+                logger.warning(f"Skipping component with unknown type: {comp_data.get('type')!r}")
+                continue
             try:
                 node = SceneGraphNode(
-                    id=comp_data.get('id', str(uuid.uuid4())),
-                    type=ComponentType(comp_data.get('type', 'pipe')),
+                    # Components without an id get one scoped to this diagram
+                    id=comp_data.get('id') or f"{diagram_id}:{i}",
+                    type=component_type,
                     name=comp_data.get('name', 'Unknown'),
                     properties=comp_data.get('properties', {}),
                     position=comp_data.get('position'),
@@ -60,11 +184,17 @@ class SceneGraphService:
         # Convert relationships
         relationships = []
         for rel_data in scene_data.get('relationships', []):
+            relationship_type = RELATIONSHIP_TYPES.get(rel_data.get('type', 'CONNECTS_TO'))
+            source_id = rel_data.get('source_id')
+            target_id = rel_data.get('target_id')
+            if relationship_type is None or source_id is None or target_id is None:
+                logger.warning(f"Skipping relationship with unknown type or missing endpoint: {rel_data!r}")
+                continue
             try:
                 relationship = SceneGraphRelationship(
-                    source_id=rel_data.get('source_id'),
-                    target_id=rel_data.get('target_id'),
-                    type=RelationshipType(rel_data.get('type', 'CONNECTS_TO')),
+                    source_id=source_id,
+                    target_id=target_id,
+                    type=relationship_type,
                     properties=rel_data.get('properties')
                 )
                 relationships.append(relationship)
@@ -75,7 +205,7 @@ class SceneGraphService:
         # Create metadata
         metadata = scene_data.get('metadata', {})
         metadata['source_filename'] = filename
-        metadata['processing_timestamp'] = str(uuid.uuid4())  # Use as timestamp placeholder
+        metadata['processing_timestamp'] = time.time_ns()  # Epoch nanoseconds
         
         scene_graph = SceneGraph(
             diagram_id=diagram_id,
@@ -87,24 +217,37 @@ class SceneGraphService:
         
         return scene_graph
     
+    def _latest_diagram_id(self) -> str:
+        latest = db.get_latest_diagram()
+        if latest is None:
+            raise ValueError("No diagrams found in database")
+        return latest['diagram_id']
+    
     def query_scene_graphs(self, question: str, diagram_id: Optional[str] = None) -> Dict[str, Any]:
         try:
-            # Get the complete scene graph data
-            if diagram_id:
-                graph_data = self._get_complete_scene_graph(diagram_id)
-            else:
-                # If no specific diagram, get the most recent one
-                diagrams = db.get_all_diagrams()
-                if not diagrams:
-                    raise ValueError("No diagrams found in database")
-                diagram_id = diagrams[0]['diagram_id']
-                graph_data = self._get_complete_scene_graph(diagram_id)
+            self.check_generation()
+            # If no specific diagram, use the most recent one
+            diagram_id = diagram_id or self._latest_diagram_id()
+            
+            cache_key = (diagram_id, normalize_question(question))
+            cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Answered from cache for diagram {diagram_id}")
+                return cached
+            
+            structured = self._try_structured_answer(cache_key[1], diagram_id)
+            if structured is not None:
+                self.answer_cache.set(cache_key, structured)
+                return structured
             
-            if not graph_data:
+            # Get the complete scene graph data, already serialized for the prompt
+            graph_json = self._get_graph_context(diagram_id)
+            if not graph_json:
                 raise ValueError(f"No data found for diagram {diagram_id}")
             
             # Use GPT to analyze the graph and answer the question
-            response = self.openai_client.answer_question_with_graph_context(question, graph_data)
+            response = self.openai_client.answer_question_with_graph_context(question, graph_json, diagram_id)
+            self.answer_cache.set(cache_key, response)
             
             logger.info(f"Question answered using full graph context")
             return response
@@ -113,33 +256,86 @@ class SceneGraphService:
             logger.error(f"Query processing failed: {e}")
             raise
     
+    def query_scene_graphs_batch(self, questions: List[str], diagram_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Answer several questions about one diagram, QA_BATCH_SIZE per model request; results follow the input order"""
+        try:
+            self.check_generation()
+            diagram_id = diagram_id or self._latest_diagram_id()
+            
+            cache_keys = [(diagram_id, normalize_question(question)) for question in questions]
+            results = [self.answer_cache.get(key) for key in cache_keys]
+            for i, result in enumerate(results):
+                if result is None:
+                    results[i] = self._try_structured_answer(cache_keys[i][1], diagram_id)
+                    if results[i] is not None:
+                        self.answer_cache.set(cache_keys[i], results[i])
+            pending = [i for i, result in enumerate(results) if result is None]
+            if not pending:
+                return results
+            
+            graph_json = self._get_graph_context(diagram_id)
+            if not graph_json:
+                raise ValueError(f"No data found for diagram {diagram_id}")
+            
+            batch_starts = range(0, len(pending), QA_BATCH_SIZE)
+            for start in batch_starts:
+                batch = pending[start:start + QA_BATCH_SIZE]
+                answers = self.openai_client.answer_questions_batch(
+                    [questions[i] for i in batch], graph_json, diagram_id
+                )
+                for i, answer in zip(batch, answers):
+                    self.answer_cache.set(cache_keys[i], answer)
+                    results[i] = answer
+            
+            logger.info(f"Answered {len(pending)} questions in {len(batch_starts)} batched requests")
+            return results
+            
+        except Exception as e:
+            logger.error(f"Batch query processing failed: {e}")
+            raise
+    
+    def _try_structured_answer(self, normalized_question: str, diagram_id: str) -> Optional[Dict[str, Any]]:
+        """Answer straight from the graph data when the question has an exact answer there"""
+        for pattern, answer_from in STRUCTURED_QUESTIONS:
+            if pattern.fullmatch(normalized_question):
+                graph_data = self._get_complete_scene_graph(diagram_id)
+                answer = answer_from(graph_data) if graph_data else None
+                if answer is None:
+                    return None
+                logger.info(f"Answered from graph data for diagram {diagram_id}")
+                return {"answer": answer, "confidence": 1.0}
+        return None
+    
+    def _get_graph_context(self, diagram_id: str) -> Optional[str]:
+        """Complete scene graph as compact JSON, rendered once per diagram"""
+        cached = self.context_cache.get(diagram_id)
+        if cached is not None:
+            return cached
+        
+        graph_data = self._get_complete_scene_graph(diagram_id)
+        if not graph_data:
+            return None
+        graph_json = orjson.dumps({
+            **graph_data,
+            'components': [without_empty(row) for row in graph_data['components']],
+            'relationships': [without_empty(row) for row in graph_data['relationships']]
+        }).decode()
+        self.context_cache.set(diagram_id, graph_json)
+        return graph_json
+    
     def _get_complete_scene_graph(self, diagram_id: str) -> Optional[Dict[str, Any]]:
         """Retrieve the complete scene graph data for a diagram"""
+        cached = self.graph_cache.get(diagram_id)
+        if cached is not None:
+            return cached
+        
         try:
-            # Get diagram info
-            diagram_info = db.get_diagram_info(diagram_id)
+            # Diagram info, components and relationships in a single query
+            diagram_info = db.get_complete_graph(diagram_id)
             if not diagram_info:
                 return None
-            
-            # Get all components
-            components = db.execute_cypher("""
-                MATCH (d:Diagram {id: $diagram_id})-[:CONTAINS]->(c:Component)
-                RETURN c.id as id, c.type as type, c.name as name,
-                       c.material as material, c.diameter as diameter, 
-                       c.length as length, c.flow_direction as flow_direction,
-                       c.position_x as position_x, c.position_y as position_y,
-                       c.width as width, c.height as height
-            """, {'diagram_id': diagram_id})
-            
-            # Get all relationships
-            relationships = db.execute_cypher("""
-                MATCH (d:Diagram {id: $diagram_id})-[:CONTAINS]->(c1:Component)
-                MATCH (d)-[:CONTAINS]->(c2:Component)
-                MATCH (c1)-[r]->(c2)
-                WHERE type(r) IN ['CONNECTS_TO', 'FLOWS_TO', 'ABOVE', 'BELOW', 'PARALLEL_TO', 'SUPPORTS', 'CONTAINS']
-                RETURN c1.id as source_id, c2.id as target_id, type(r) as relationship_type,
-                       r.distance as distance, r.angle as angle
-            """, {'diagram_id': diagram_id})
+            components = diagram_info['components']
+            relationships = diagram_info['relationships']
             
             # Structure the data
             graph_data = {
@@ -160,6 +356,7 @@ class SceneGraphService:
                 }
             }
             
+            self.graph_cache.set(diagram_id, graph_data)
             return graph_data
             
         except Exception as e:
@@ -167,6 +364,15 @@ class SceneGraphService:
             return None
     
     
+    def get_components_payload(self, diagram_id: str) -> Optional[bytes]:
+        """Overlay JSON for a diagram, built from its current components (later diagrams can update
+        them, since components are merged by id)"""
+        self.check_generation()
+        graph_data = self._get_complete_scene_graph(diagram_id)
+        if not graph_data:
+            return None
+        return format_components(diagram_id, graph_data['components'])
+    
     def get_diagram_summary(self, diagram_id: str) -> Optional[Dict[str, Any]]:
         try:
             info = db.get_diagram_info(diagram_id)
@@ -15,7 +15,7 @@ fi
 
 # Start backend in background
 echo "📡 Starting FastAPI backend (port 8000)..."
-source .venv/bin/activate && python main.py &
+source .venv/bin/activate && DEV=1 python main.py &
 BACKEND_PID=$!
 
 # Give backend time to start
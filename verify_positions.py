@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from matplotlib.collections import EllipseCollection
 from PIL import Image
+import argparse
 import sys
 import os
+import time
 
 # Add current directory to path for imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -12,8 +15,24 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from database import db
 from config import Config
 
-def verify_component_positions():
-    """Fetch positions from Neo4j and plot them on SimpleRiser.png for verification"""
+# Shared by every component ID label
+ID_LABEL_BBOX = dict(boxstyle='round,pad=0.2', facecolor='white', alpha=0.8)
+# Above this many components only the numbered badges are labelled; -v prints the number-to-ID list
+MAX_ID_LABELS = 200
+# Components drawn per plot by default; larger diagrams are viewed a page at a time
+DEFAULT_MAX_COMPONENTS = 5000
+
+def verify_component_positions(save_path=None, diagram_id=None, verbose=False,
+                               max_components=DEFAULT_MAX_COMPONENTS, page=0):
+    """Fetch positions from Neo4j and plot them on SimpleRiser.png for verification.
+    
+    Uses the newest diagram unless diagram_id is given; verbose lists every component's position.
+    With save_path the plot is rendered headless (Agg) to that file instead of opening a window.
+    At most max_components are drawn, taken in id order starting at page * max_components.
+    """
+    
+    if save_path:
+        plt.switch_backend('Agg')
     
     try:
         # Check if image exists
@@ -24,83 +43,116 @@ def verify_component_positions():
         
         print("✓ Loading SimpleRiser.png...")
         
-        # Load the image
-        img = Image.open(image_path)
-        img_array = plt.imread(image_path)
-        
-        print(f"✓ Image loaded: {img.size[0]}x{img.size[1]} pixels")
-        
-        # Get all diagrams
-        diagrams = db.get_all_diagrams()
-        if not diagrams:
-            print("❌ No diagrams found in database")
-            return
-        
-        # Use the first (most recent) diagram
-        diagram_id = diagrams[0]['diagram_id']
-        diagram_title = diagrams[0].get('title', 'Unknown')
+        # Load the image once; dimensions come from the decoded array.
+        # The decoded pixels are kept next to the PNG so repeat runs skip the decode.
+        cache_path = image_path + '.npy'
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(image_path):
+            img_array = np.load(cache_path, mmap_mode='r')
+        else:
+            img_array = plt.imread(image_path)
+            np.save(cache_path, img_array)
+        h, w = img_array.shape[:2]
+        
+        print(f"✓ Image loaded: {w}x{h} pixels")
+        
+        # The script can run without the API having started, so make sure the Diagram.id constraint backs the lookups
+        db.create_schema()
+        
+        if diagram_id:
+            diagram_title = diagram_id
+        else:
+            # Use the most recent diagram
+            latest = db.get_latest_diagram()
+            if latest is None:
+                print("❌ No diagrams found in database")
+                return
+            diagram_id = latest['diagram_id']
+            diagram_title = latest.get('title') or 'Unknown'
         
         print(f"✓ Using diagram: {diagram_title}")
         print(f"  Diagram ID: {diagram_id}")
         
         # Fetch component positions from Neo4j
-        components = db.execute_cypher("""
+        records = db.execute_cypher_iter("""
             MATCH (d:Diagram {id: $diagram_id})-[:CONTAINS]->(c:Component)
-            RETURN c.id as id, c.name as name, c.type as type,
-                   c.position_x as position_x, c.position_y as position_y,
-                   c.material as material, c.diameter as diameter
+            RETURN c.id AS id, c.name AS name, c.position_x AS x, c.position_y AS y
             ORDER BY c.id
-        """, {'diagram_id': diagram_id})
+            SKIP $skip LIMIT $limit
+        """, {'diagram_id': diagram_id, 'skip': page * max_components, 'limit': max_components})
+        # Records are consumed as they stream in, keeping only (id, name, x, y) tuples
+        components = [(r['id'], r['name'], r['x'] or 0, r['y'] or 0) for r in records]
         
         if not components:
             print("❌ No components found for diagram")
             return
         
-        print(f"✓ Found {len(components)} components in database")
+        first = page * max_components
+        print(f"✓ Found {len(components)} components in database (#{first + 1}-#{first + len(components)})")
+        if len(components) == max_components:
+            print(f"  Limited to {max_components}; use --page {page + 1} for the next components")
+        
+        render_start = time.perf_counter()
         
         # Create the plot
         fig, ax = plt.subplots(1, 1, figsize=(12, 10))
-        ax.imshow(img_array)
+        
+        # Shrink very large images to roughly the figure's pixel width; extent keeps the original coordinates
+        target_w = int(fig.get_size_inches()[0] * fig.dpi)
+        step = -(-w // target_w) if w > 2 * target_w else 1
+        background = img_array
+        if step > 1:
+            if background.dtype != np.uint8:
+                background = (np.asarray(background) * 255).round().astype(np.uint8)
+            # Area-average reduction (on the already decoded pixels) keeps 1-2 px pipe strokes visible
+            background = np.asarray(Image.fromarray(background).reduce(step))
+        ax.imshow(background, extent=[0, w, h, 0])
         ax.set_title(f"Component Position Verification\n{diagram_title}", fontsize=14, pad=20)
         
+        # Limits are set explicitly below, so skip re-autoscaling as each label is added
+        ax.set_autoscale_on(False)
+        
+        # Test if positions are percentages (0-100) of image dimensions, for all components at once
+        raw = np.array([c[2:] for c in components], dtype=np.float64)
+        xs = np.where(raw[:, 0] <= 100, raw[:, 0] / 100.0 * w, raw[:, 0])
+        ys = np.where(raw[:, 1] <= 100, raw[:, 1] / 100.0 * h, raw[:, 1])
+        
+        show_ids = len(components) <= MAX_ID_LABELS
+        lines = []
+        
         # Plot each component position - testing percentage interpretation
-        for i, component in enumerate(components):
-            comp_id = component['id']
-            name = component['name']
-            x_pos_raw = component.get('position_x', 0) or 0
-            y_pos_raw = component.get('position_y', 0) or 0
-            material = component.get('material', '')
-            diameter = component.get('diameter', '')
-            
-            # Test if positions are percentages (0-100) of image dimensions
-            x_pos_pixels = (x_pos_raw / 100.0) * img.size[0] if x_pos_raw <= 100 else x_pos_raw
-            y_pos_pixels = (y_pos_raw / 100.0) * img.size[1] if y_pos_raw <= 100 else y_pos_raw
-            
-            print(f"  {i+1:2d}. {comp_id}: {name}")
-            print(f"      Raw Position: ({x_pos_raw}, {y_pos_raw})")
-            print(f"      As Percentages: ({x_pos_pixels:.1f}, {y_pos_pixels:.1f}) pixels")
-            print(f"      Material: {material}, Diameter: {diameter}")
-            
-            # Plot the badge at percentage-based coordinates
-            circle = patches.Circle((x_pos_pixels, y_pos_pixels), radius=15, 
-                                  facecolor='blue', edgecolor='white', 
-                                  linewidth=2, alpha=0.8)
-            ax.add_patch(circle)
+        for i, ((comp_id, name, x_pos_raw, y_pos_raw), x_pos_pixels, y_pos_pixels) in enumerate(zip(components, xs, ys)):
+            if verbose:
+                lines.append(f"  {first+i+1:2d}. {comp_id}: {name}")
+                lines.append(f"      Raw Position: ({x_pos_raw}, {y_pos_raw})")
+                lines.append(f"      As Percentages: ({x_pos_pixels:.1f}, {y_pos_pixels:.1f}) pixels")
             
             # Add number label
-            ax.text(x_pos_pixels, y_pos_pixels, str(i + 1), 
+            ax.text(x_pos_pixels, y_pos_pixels, str(first + i + 1), 
                    ha='center', va='center', 
                    color='white', fontweight='bold', fontsize=10)
             
             # Add component ID as small text nearby
-            ax.text(x_pos_pixels + 20, y_pos_pixels - 20, comp_id, 
-                   ha='left', va='center', 
-                   color='red', fontweight='bold', fontsize=8,
-                   bbox=dict(boxstyle='round,pad=0.2', facecolor='white', alpha=0.8))
+            if show_ids:
+                ax.text(x_pos_pixels + 20, y_pos_pixels - 20, comp_id, 
+                       ha='left', va='center', 
+                       color='red', fontweight='bold', fontsize=8,
+                       bbox=ID_LABEL_BBOX)
+        
+        # One write for the whole listing rather than three prints per component
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+        print(f"✓ Placed {len(components)} markers")
+        
+        # All badges as one artist: 30px circles (radius 15) in data coordinates
+        badges = EllipseCollection(widths=30, heights=30, angles=0, units='xy',
+                                   offsets=np.column_stack([xs, ys]), offset_transform=ax.transData,
+                                   facecolors='blue', edgecolors='white',
+                                   linewidths=2, alpha=0.8)
+        ax.add_collection(badges)
         
         # Set axis properties
-        ax.set_xlim(0, img.size[0])
-        ax.set_ylim(img.size[1], 0)  # Invert Y axis for image coordinates
+        ax.set_xlim(0, w)
+        ax.set_ylim(h, 0)  # Invert Y axis for image coordinates
         ax.set_xlabel('X Coordinate (pixels)')
         ax.set_ylabel('Y Coordinate (pixels)')
         ax.grid(True, alpha=0.3)
@@ -110,13 +162,18 @@ def verify_component_positions():
                 transform=ax.transAxes, verticalalignment='top',
                 bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
         
-        print(f"\n📊 Displaying verification plot...")
+        print(f"\n📊 {'Saving' if save_path else 'Displaying'} verification plot...")
         print(f"   Blue circles show database positions")
         print(f"   Red labels show component IDs")
         print(f"   Compare with actual component locations on diagram")
         
         plt.tight_layout()
-        plt.show()
+        if save_path:
+            fig.savefig(save_path, dpi=100, bbox_inches='tight')
+            print(f"   Saved to {save_path} in {time.perf_counter() - render_start:.2f}s")
+        else:
+            print(f"   Plot built in {time.perf_counter() - render_start:.2f}s")
+            plt.show()
         
         print(f"\n✅ Verification complete!")
         print(f"   Check if blue badges align with actual plumbing components")
@@ -127,7 +184,16 @@ def verify_component_positions():
         print("\nMake sure you have:")
         print("1. Neo4j database connection configured")
         print("2. At least one processed diagram in the database")
-        print("3. matplotlib and Pillow installed")
+        print("3. matplotlib, NumPy and Pillow installed")
 
 if __name__ == "__main__":
-    verify_component_positions()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=verify_component_positions.__doc__.splitlines()[0])
+    parser.add_argument('--save', metavar='OUTFILE', help="write the plot to OUTFILE instead of showing it")
+    parser.add_argument('--diagram-id', help="diagram to verify (default: the most recent one)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print each component's raw and pixel position")
+    parser.add_argument('--max', type=int, default=DEFAULT_MAX_COMPONENTS, metavar='N',
+                        help=f"draw at most N components (default: {DEFAULT_MAX_COMPONENTS})")
+    parser.add_argument('--page', type=int, default=0, metavar='K', help="draw the K-th page of N components, from 0")
+    args = parser.parse_args()
+    verify_component_positions(save_path=args.save, diagram_id=args.diagram_id, verbose=args.verbose,
+                               max_components=args.max, page=args.page)
\ No newline at end of file